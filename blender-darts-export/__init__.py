@@ -14,16 +14,20 @@ if "bpy" in locals():
     if "camera" in locals():
         importlib.reload(camera)
 
+import time
+
 import bpy
-import bpy_extras
-from bpy.props import BoolProperty, IntProperty, StringProperty, EnumProperty
+from bpy.props import BoolProperty, StringProperty, EnumProperty
+
+# ExportHelper is a base class of the operator, so it can't be imported lazily. Everything
+# else (the scene writer and its submodules) is only imported once an export is run
 from bpy_extras.io_utils import ExportHelper
 
 bl_info = {
     "name": "Darts",
     "author": "Wojciech Jarosz, Baptiste Nicolet, Shaojie Jiao, Adrien Gruson, Delio Vicini, Tizian Zeltner",
     "version": (1, 0, 0),
-    "blender": (2, 80, 0),
+    "blender": (3, 3, 0),
     "location": "File > Export > Darts exporter (.json)",
     "description": "Export Darts scene format (.json)",
     "warning": "",
@@ -33,6 +37,206 @@ bl_info = {
 }
 
 
+INTEGRATOR_ITEMS = (
+    ("none", "None", "Do not include an integrator at all"),
+    ("ao", "ao", "Use the ambient occlusion integrator"),
+    ("normals", "normals", "Use the normals integrator"),
+    (
+        "path tracer mis",
+        "path tracer mis",
+        "Use the MIS-based path tracing integrator",
+    ),
+    (
+        "volume path tracer mis",
+        "volume path tracer mis",
+        "Use the MIS-based volume path tracing integrator",
+    ),
+)
+
+SAMPLER_ITEMS = (
+    ("none", "None", "Do not include a sampler at all"),
+    ("independent", "independent", "Independent sampler"),
+    ("stratified", "stratified", "Stratified sampler"),
+    ("cmj", "cmj", "Correlated multi-jittered sampler"),
+    ("oa", "oa", "Orthogonal array sampler"),
+    ("psobol2d", "psobol2d", "Padded 2D Sobol sampler"),
+    ("ssobol", "ssobol", "Stochastic Sobol sampler"),
+)
+
+MESH_MODE_ITEMS = (
+    (
+        "SINGLE",
+        "a single mesh",
+        "Write all scene geometry out as a single mesh (OBJ file)",
+    ),
+    (
+        "SPLIT",
+        "one mesh per Blender object",
+        "Write each Blender object out as a separate mesh (OBJ file)",
+    ),
+)
+
+MATERIAL_MODE_ITEMS = (
+    (
+        "OFF",
+        "None",
+        "Do not write materials to OBJ. Include a single default material in the Darts scene to use for all surfaces",
+    ),
+    (
+        "ONE",
+        "One default material",
+        "Write materials to OBJ and a single default material in the Darts scene to use for all surfaces",
+    ),
+    (
+        "DIFFUSE",
+        "Diffuse placeholder materials",
+        "Write OBJ materials and create a placeholder diffuse material in Darts for each Blender material",
+    ),
+    (
+        "CONVERT",
+        "Convert Blender materials",
+        "Write OBJ materials and create an approximately equivalent Darts material for each Blender material",
+    ),
+)
+
+GLOSSY_MODE_ITEMS = (
+    (
+        "metal",
+        "metal",
+        "Convert Blender's `Glossy` material to a `metal` Darts material",
+    ),
+    (
+        "phong",
+        "phong",
+        "Convert Blender's `Glossy` material to a `phong` Darts material",
+    ),
+    (
+        "blinn-phong",
+        "blinn-phong",
+        "Convert Blender's `Glossy` material to a `blinn-phong` Darts material",
+    ),
+    (
+        "rough conductor",
+        "(rough) conductor",
+        "Convert Blender's `Glossy` material to a `conductor` or `rough conductor` Darts material",
+    ),
+)
+
+# Texture conversion toggles, drawn in this order: (property name, label, description)
+TEXTURE_TOGGLES = (
+    (
+        "enable_background",
+        "Background",
+        "Export background color (constant or envmap). When disabled, Darts' background is set to a fixed 5",
+    ),
+    (
+        "enable_blackbody",
+        "Blackbody",
+        "Convert Blender Blackbody texture node to a Darts 'blackbody' texture",
+    ),
+    (
+        "enable_brick",
+        "Brick",
+        "Convert Blender Brick texture node to a Darts 'brick' texture",
+    ),
+    (
+        "enable_clamp",
+        "Clamp",
+        "Convert Blender Clamp converter node to a Darts 'clamp' texture",
+    ),
+    (
+        "enable_color_ramp",
+        "Color ramp",
+        "Convert Blender Color Ramp converter node to a Darts 'color ramp' texture",
+    ),
+    (
+        "enable_coord",
+        "Coord texture",
+        "Convert Blender Texture Coordinate input nodes into Darts 'coord' textures",
+    ),
+    (
+        "enable_checker",
+        "Checker",
+        "Convert Blender Checker texture node to a Darts 'checker' texture",
+    ),
+    (
+        "enable_fresnel",
+        "Fresnel",
+        "Convert Blender Fresnel input node to a Darts 'fresnel' texture. When disabled, Fresnel nodes are converted to a fixed 0.5",
+    ),
+    (
+        "enable_gradient",
+        "Gradient",
+        "Convert Blender Gradient texture node to a Darts 'gradient' texture",
+    ),
+    (
+        "enable_layer_weight",
+        "Layer Weight",
+        "Convert Blender Layer Weight input node to a Darts 'layer weight' texture. When disabled, Layer Weight nodes are converted to a fixed 0.5",
+    ),
+    (
+        "enable_mapping",
+        "Mapping",
+        "Convert Blender Mapping vector nodes to a Dart Texture's 'mapping' field",
+    ),
+    (
+        "enable_math",
+        "Math",
+        "Convert Blender Math converter nodes to Darts 'math' textures",
+    ),
+    (
+        "enable_mix_rgb",
+        "Mix RGB",
+        "Convert Blender Mix RGB color node to a Darts 'mix' texture",
+    ),
+    (
+        "enable_mix_node",
+        "Mix",
+        "Convert Blender Mix converter node to a Darts 'mix' texture",
+    ),
+    (
+        "enable_musgrave",
+        "Musgrave",
+        "Convert Blender Musgrave texture node to a Darts 'musgrave' texture. When disabled, Musgrave textures are converted to a fixed 0.5",
+    ),
+    (
+        "enable_noise",
+        "Noise",
+        "Convert Blender Noise texture node to a Darts 'noise' texture. When disabled, Noise textures are converted to a fixed 0.5",
+    ),
+    (
+        "enable_separate",
+        "Separate",
+        "Convert Blender Separate XYZ/Color converter nodes to a Darts 'separate' texture",
+    ),
+    (
+        "enable_voronoi",
+        "Voronoi",
+        "Convert Blender Voronoi texture node to a Darts 'voronoi' texture. When disabled, Voronoi textures are converted to a fixed 0.5",
+    ),
+    (
+        "enable_wave",
+        "Wave",
+        "Convert Blender Wave shader node to a Darts 'wave' texture",
+    ),
+    (
+        "enable_wavelength",
+        "Wavelength",
+        "Convert Blender Wavelength shader to a Darts 'wavelength' texture",
+    ),
+    (
+        "enable_wireframe",
+        "Wireframe",
+        "Convert Blender Wireframe input node to a Darts 'wavelength' texture",
+    ),
+)
+
+# How long (in seconds) the modal export works through steps before handing control back to Blender.
+# Individual steps can be as small as a single object, so running one step per timer event would
+# mostly leave the export waiting on the timer
+MODAL_STEP_BUDGET = 0.05
+
+
 class DartsExporter(bpy.types.Operator, ExportHelper):
     """Export as a Darts scene"""
 
@@ -47,6 +251,11 @@ class DartsExporter(bpy.types.Operator, ExportHelper):
         description="Print out extra info in Blender's Info Log",
         default=False,
     )
+    profile: BoolProperty(
+        name="Profile export",
+        description="Profile the export with cProfile and save the stats next to the scene file",
+        default=False,
+    )
     use_selection: BoolProperty(
         name="Selection Only",
         description="Export selected objects only",
@@ -66,34 +275,12 @@ class DartsExporter(bpy.types.Operator, ExportHelper):
     # Scene-wide settings
     integrator: EnumProperty(
         name="Integrator",
-        items=(
-            ("none", "None", "Do not include an integrator at all"),
-            ("ao", "ao", "Use the ambient occlusion integrator"),
-            ("normals", "normals", "Use the normals integrator"),
-            (
-                "path tracer mis",
-                "path tracer mis",
-                "Use the MIS-based path tracing integrator",
-            ),
-            (
-                "volume path tracer mis",
-                "volume path tracer mis",
-                "Use the MIS-based volume path tracing integrator",
-            ),
-        ),
+        items=INTEGRATOR_ITEMS,
         default="path tracer mis",
     )
     sampler: EnumProperty(
         name="Sampler",
-        items=(
-            ("none", "None", "Do not include a sampler at all"),
-            ("independent", "independent", "Independent sampler"),
-            ("stratified", "stratified", "Stratified sampler"),
-            ("cmj", "cmj", "Correlated multi-jittered sampler"),
-            ("oa", "oa", "Orthogonal array sampler"),
-            ("psobol2d", "psobol2d", "Padded 2D Sobol sampler"),
-            ("ssobol", "ssobol", "Stochastic Sobol sampler"),
-        ),
+        items=SAMPLER_ITEMS,
         default="independent",
     )
     use_lights: BoolProperty(
@@ -105,72 +292,24 @@ class DartsExporter(bpy.types.Operator, ExportHelper):
     # Geometry/OBJ export-related settings
     mesh_mode: EnumProperty(
         name="Convert to",
-        items=(
-            (
-                "SINGLE",
-                "a single mesh",
-                "Write all scene geometry out as a single mesh (OBJ file)",
-            ),
-            (
-                "SPLIT",
-                "one mesh per Blender object",
-                "Write each Blender object out as a separate mesh (OBJ file)",
-            ),
-        ),
+        items=MESH_MODE_ITEMS,
         default="SINGLE",
     )
+    use_render_settings: BoolProperty(
+        name="Use render settings",
+        description="Evaluate modifiers and curve resolutions with their render settings, as for a final render. Otherwise export the geometry as shown in the viewport",
+        default=True,
+    )
 
     # Material-related settings
     material_mode: EnumProperty(
         name="Materials",
-        items=(
-            (
-                "OFF",
-                "None",
-                "Do not write materials to OBJ. Include a single default material in the Darts scene to use for all surfaces",
-            ),
-            (
-                "ONE",
-                "One default material",
-                "Write materials to OBJ and a single default material in the Darts scene to use for all surfaces",
-            ),
-            (
-                "DIFFUSE",
-                "Diffuse placeholder materials",
-                "Write OBJ materials and create a placeholder diffuse material in Darts for each Blender material",
-            ),
-            (
-                "CONVERT",
-                "Convert Blender materials",
-                "Write OBJ materials and create an approximately equivalent Darts material for each Blender material",
-            ),
-        ),
+        items=MATERIAL_MODE_ITEMS,
         default="CONVERT",
     )
     glossy_mode: EnumProperty(
         name="Glossy as",
-        items=(
-            (
-                "metal",
-                "metal",
-                "Convert Blender's `Glossy` material to a `metal` Darts material",
-            ),
-            (
-                "phong",
-                "phong",
-                "Convert Blender's `Glossy` material to a `phong` Darts material",
-            ),
-            (
-                "blinn-phong",
-                "blinn-phong",
-                "Convert Blender's `Glossy` material to a `blinn-phong` Darts material",
-            ),
-            (
-                "rough conductor",
-                "(rough) conductor",
-                "Convert Blender's `Glossy` material to a `conductor` or `rough conductor` Darts material",
-            ),
-        ),
+        items=GLOSSY_MODE_ITEMS,
         default="rough conductor",
     )
     force_two_sided: BoolProperty(
@@ -189,126 +328,78 @@ class DartsExporter(bpy.types.Operator, ExportHelper):
         default=False,
     )
 
-    # Texture-related settings
-    enable_background: BoolProperty(
-        name="Background",
-        description="Export background color (constant or envmap). When disabled, Darts' background is set to a fixed 5",
-        default=True,
-    )
+    # Texture-related settings (the enable_* toggles are added from TEXTURE_TOGGLES in register())
     write_texture_files: BoolProperty(
         name="Write textures",
         description="Uncheck this to write out the Darts scene file, but not write out any textures to disk",
         default=True,
     )
-    enable_blackbody: BoolProperty(
-        name="Blackbody",
-        description="Convert Blender Blackbody texture node to a Darts 'blackbody' texture",
-        default=True,
-    )
-    enable_brick: BoolProperty(
-        name="Brick",
-        description="Convert Blender Brick texture node to a Darts 'brick' texture",
-        default=True,
-    )
-    enable_checker: BoolProperty(
-        name="Checker",
-        description="Convert Blender Checker texture node to a Darts 'checker' texture",
-        default=True,
-    )
-    enable_clamp: BoolProperty(
-        name="Clamp",
-        description="Convert Blender Clamp converter node to a Darts 'clamp' texture",
-        default=True,
-    )
-    enable_color_ramp: BoolProperty(
-        name="Color ramp",
-        description="Convert Blender Color Ramp converter node to a Darts 'color ramp' texture",
-        default=True,
-    )
-    enable_coord: BoolProperty(
-        name="Coord texture",
-        description="Convert Blender Texture Coordinate input nodes into Darts 'coord' textures",
-        default=True,
-    )
-    enable_fresnel: BoolProperty(
-        name="Fresnel",
-        description="Convert Blender Fresnel input node to a Darts 'fresnel' texture. When disabled, Fresnel nodes are converted to a fixed 0.5",
-        default=True,
-    )
-    enable_gradient: BoolProperty(
-        name="Gradient",
-        description="Convert Blender Gradient texture node to a Darts 'gradient' texture",
-        default=True,
-    )
-    enable_layer_weight: BoolProperty(
-        name="Layer Weight",
-        description="Convert Blender Layer Weight input node to a Darts 'layer weight' texture. When disabled, Layer Weight nodes are converted to a fixed 0.5",
-        default=True,
-    )
-    enable_mapping: BoolProperty(
-        name="Mapping",
-        description="Convert Blender Mapping vector nodes to a Dart Texture's 'mapping' field",
-        default=True,
-    )
-    enable_math: BoolProperty(
-        name="Math",
-        description="Convert Blender Math converter nodes to Darts 'math' textures",
-        default=True,
-    )
-    enable_mix_rgb: BoolProperty(
-        name="Mix RGB",
-        description="Convert Blender Mix RGB color node to a Darts 'mix' texture",
-        default=True,
-    )
-    enable_mix_node: BoolProperty(
-        name="Mix",
-        description="Convert Blender Mix converter node to a Darts 'mix' texture",
-        default=True,
-    )
-    enable_musgrave: BoolProperty(
-        name="Musgrave",
-        description="Convert Blender Musgrave texture node to a Darts 'musgrave' texture. When disabled, Musgrave textures are converted to a fixed 0.5",
-        default=True,
-    )
-    enable_noise: BoolProperty(
-        name="Noise",
-        description="Convert Blender Noise texture node to a Darts 'noise' texture. When disabled, Noise textures are converted to a fixed 0.5",
-        default=True,
-    )
-    enable_separate: BoolProperty(
-        name="Separate",
-        description="Convert Blender Separate XYZ/Color converter nodes to a Darts 'separate' texture",
-        default=True,
-    )
-    enable_voronoi: BoolProperty(
-        name="Voronoi",
-        description="Convert Blender Voronoi texture node to a Darts 'voronoi' texture. When disabled, Voronoi textures are converted to a fixed 0.5",
-        default=True,
-    )
-    enable_wave: BoolProperty(
-        name="Wave",
-        description="Convert Blender Wave shader node to a Darts 'wave' texture",
-        default=True,
-    )
-    enable_wavelength: BoolProperty(
-        name="Wavelength",
-        description="Convert Blender Wavelength shader to a Darts 'wavelength' texture",
-        default=True,
-    )
-    enable_wireframe: BoolProperty(
-        name="Wireframe",
-        description="Convert Blender Wireframe input node to a Darts 'wavelength' texture",
-        default=True,
-    )
+
+    def invoke(self, context, event):
+        # exports started from the UI run as a modal operator once the file is chosen, so Blender
+        # stays responsive and ESC cancels. execute() on its own (scripts, redo) stays synchronous
+        self._run_modal = True
+        return ExportHelper.invoke(self, context, event)
 
     def execute(self, context):
         from . import scene
 
         keywords = self.as_keywords(ignore=("check_existing", "filter_glob"))
         converter = scene.SceneWriter(context, self.report, **keywords)
-        converter.write()
 
-        return {"FINISHED"}
+        if not getattr(self, "_run_modal", False) or context.window is None:
+            converter.write()
+            return {"FINISHED"}
+
+        # run a few export steps per timer event, so Blender can redraw and ESC cancels
+        self._converter = converter
+        self._steps = converter.write_steps()
+
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(0.01, window=context.window)
+        wm.progress_begin(0.0, 1.0)
+        wm.modal_handler_add(self)
+        return {"RUNNING_MODAL"}
+
+    def modal(self, context, event):
+        if event.type == "ESC":
+            self._finish(context)
+            self._report_partial_export("Darts export cancelled")
+            return {"CANCELLED"}
+
+        if event.type != "TIMER":
+            return {"PASS_THROUGH"}
+
+        # don't hold on to the context from a previous event
+        self._converter.context = context
+        deadline = time.perf_counter() + MODAL_STEP_BUDGET
+        try:
+            progress = next(self._steps)
+            while time.perf_counter() < deadline:
+                progress = next(self._steps)
+        except StopIteration:
+            self._finish(context)
+            return {"FINISHED"}
+        except Exception:
+            self._finish(context)
+            self._report_partial_export("Darts export failed")
+            raise
+
+        context.window_manager.progress_update(progress)
+        return {"RUNNING_MODAL"}
+
+    def _report_partial_export(self, reason):
+        # the meshes, textures and volumes written so far are left in the output directory
+        self.report(
+            {"WARNING"},
+            f"{reason}; '{self._converter.directory}' may contain a partial export.",
+        )
+
+    def _finish(self, context):
+        self._steps.close()
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
 
     def draw(self, context):
         pass
@@ -336,6 +427,7 @@ class DARTS_PT_export_include(bpy.types.Panel):
         operator = sfile.active_operator
 
         layout.prop(operator, "verbose")
+        layout.prop(operator, "profile")
 
         sublayout = layout.column(heading="Limit to")
         sublayout.prop(operator, "use_selection")
@@ -390,6 +482,7 @@ class DARTS_PT_export_geometry(bpy.types.Panel):
         operator = sfile.active_operator
 
         layout.prop(operator, "mesh_mode")
+        layout.prop(operator, "use_render_settings")
         layout.prop(operator, "write_obj_files")
 
 
@@ -449,27 +542,8 @@ class DARTS_PT_export_textures(bpy.types.Panel):
         sublayout = layout.column(heading="Enable")
 
         sublayout.prop(operator, "write_texture_files")
-        sublayout.prop(operator, "enable_background")
-        sublayout.prop(operator, "enable_blackbody")
-        sublayout.prop(operator, "enable_brick")
-        sublayout.prop(operator, "enable_clamp")
-        sublayout.prop(operator, "enable_color_ramp")
-        sublayout.prop(operator, "enable_coord")
-        sublayout.prop(operator, "enable_checker")
-        sublayout.prop(operator, "enable_fresnel")
-        sublayout.prop(operator, "enable_gradient")
-        sublayout.prop(operator, "enable_layer_weight")
-        sublayout.prop(operator, "enable_mapping")
-        sublayout.prop(operator, "enable_math")
-        sublayout.prop(operator, "enable_mix_rgb")
-        sublayout.prop(operator, "enable_mix_node")
-        sublayout.prop(operator, "enable_musgrave")
-        sublayout.prop(operator, "enable_noise")
-        sublayout.prop(operator, "enable_separate")
-        sublayout.prop(operator, "enable_voronoi")
-        sublayout.prop(operator, "enable_wave")
-        sublayout.prop(operator, "enable_wavelength")
-        sublayout.prop(operator, "enable_wireframe")
+        for name, _, _ in TEXTURE_TOGGLES:
+            sublayout.prop(operator, name)
 
 
 def menu_func_export(self, context):
@@ -487,6 +561,12 @@ classes = (
 
 
 def register():
+    # all texture toggles are plain on/off switches, so they are generated from a table
+    for name, label, description in TEXTURE_TOGGLES:
+        DartsExporter.__annotations__[name] = BoolProperty(
+            name=label, description=description, default=True
+        )
+
     for cls in classes:
         bpy.utils.register_class(cls)
 
@@ -1,10 +1,7 @@
-from mathutils import Matrix
-from mathutils import Vector
 from math import degrees, atan, tan
 
 
 def export(ctx, b_scene):
-
     # only exporting one camera
     cameras = [cam for cam in ctx.context.scene.objects
                if cam.type in {'CAMERA'}]
@@ -41,10 +38,11 @@ def export(ctx, b_scene):
     percent = b_scene.render.resolution_percentage / 100.0
     params["resolution"] = [int(res_x * percent), int(res_y * percent)]
 
-    # up, lookat, and position
-    up = b_camera.matrix_world.to_quaternion() @ Vector((0.0, 1.0, 0.0))
-    direction = b_camera.matrix_world.to_quaternion() @ Vector((0.0, 0.0, -1.0))
-    loc = b_camera.matrix_world.to_translation()
+    # up, lookat, and position: read directly off the columns of the camera's world matrix
+    mw = b_camera.matrix_world
+    up = mw.col[1].to_3d().normalized()
+    direction = -mw.col[2].to_3d().normalized()
+    loc = mw.to_translation()
 
     # set the values and return
     params["transform"] = {
@@ -65,7 +63,7 @@ def export(ctx, b_scene):
 
         if b_camera.data.dof.focus_object is not None:
             # compute distance to object location projected along the camera view direction
-            params["focus distance"] = abs(b_camera.matrix_world.col[2].to_3d().normalized().dot(
+            params["focus distance"] = abs(direction.dot(
                 b_camera.data.dof.focus_object.matrix_world.to_translation() - loc))
         else:
             params["focus distance"] = b_camera.data.dof.focus_distance
@@ -1,59 +1,382 @@
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import bpy
+import numpy as np
 
 # from mathutils import Matrix, Vector, Euler
 
+# the OBJ writer relies on mesh APIs (e.g. color attributes) that older versions don't have
+if bpy.app.version < (3, 3, 0):
+    raise ImportError("The Darts exporter requires Blender 3.3 or newer")
 
-def write_obj(ctx, obj_name):
-    """Export meshes to "meshes/" and then point to them in the scene file"""
+# size of the write buffer used for the exported files
+WRITE_BUFFER_SIZE = 1 << 20
 
-    relative_path = os.path.join("meshes", obj_name + ".obj")
+# how many lines format_obj formats (and yields) at once
+ROWS_PER_BLOCK = 1 << 16
 
-    # skip if we've already exported this object
+# how many extracted meshes (per worker thread) may wait to be written in SPLIT mode. Each keeps
+# its NumPy arrays alive until its OBJ file is written, so this bounds the memory used
+PENDING_WRITES_PER_WORKER = 2
+
+
+def linear_to_srgb(c):
+    """Convert an array of linear color values to sRGB"""
+    c = np.clip(c, 0.0, 1.0)
+    return np.where(c <= 0.0031308, 12.92 * c, 1.055 * np.power(c, 1.0 / 2.4) - 0.055)
+
+
+def mesh_arrays(mesh):
+    """
+    Pull the triangulated geometry of a Blender mesh into flat NumPy arrays using foreach_get.
+
+    The triangles come from Blender's own (cached) loop triangulation, so there is no need to
+    triangulate the mesh with bmesh or ask an exporter to do it.
+
+    Returns a dict with per-vertex positions (and colors, if any), per-corner normals (and uvs, if any),
+    and for each triangle its three vertex indices, corner indices, and material index.
+    """
+    mesh.calc_loop_triangles()
+
+    num_verts = len(mesh.vertices)
+    num_loops = len(mesh.loops)
+    num_tris = len(mesh.loop_triangles)
+
+    co = np.empty(num_verts * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+
+    loop_verts = np.empty(num_loops, dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_verts)
+
+    tri_loops = np.empty(num_tris * 3, dtype=np.int32)
+    mesh.loop_triangles.foreach_get("loops", tri_loops)
+
+    tri_mats = np.empty(num_tris, dtype=np.int32)
+    mesh.loop_triangles.foreach_get("material_index", tri_mats)
+
+    normals = np.empty(num_loops * 3, dtype=np.float32)
+    if hasattr(mesh, "corner_normals"):
+        # Blender 4.1+
+        mesh.corner_normals.foreach_get("vector", normals)
+    else:
+        mesh.calc_normals_split()
+        mesh.loops.foreach_get("normal", normals)
+
+    uvs = None
+    if mesh.uv_layers.active is not None:
+        uvs = np.empty(num_loops * 2, dtype=np.float32)
+        mesh.uv_layers.active.data.foreach_get("uv", uvs)
+
+    # OBJ only supports per-vertex colors, so average corner colors onto their vertices
+    colors = None
+    color_attribute = mesh.color_attributes.active_color
+    if color_attribute is not None and color_attribute.domain in {"POINT", "CORNER"}:
+        rgba = np.empty(len(color_attribute.data) * 4, dtype=np.float32)
+        color_attribute.data.foreach_get("color", rgba)
+        rgb = rgba.reshape(-1, 4)[:, :3]
+        if color_attribute.domain == "CORNER":
+            sums = np.zeros((num_verts, 3), dtype=np.float32)
+            np.add.at(sums, loop_verts, rgb)
+            counts = np.bincount(loop_verts, minlength=num_verts).reshape(-1, 1)
+            rgb = sums / np.maximum(counts, 1)
+        colors = linear_to_srgb(rgb)
+
+    return {
+        "co": co.reshape(-1, 3),
+        "colors": colors,
+        "normals": normals.reshape(-1, 3),
+        "uvs": None if uvs is None else uvs.reshape(-1, 2),
+        "tri_verts": loop_verts[tri_loops].reshape(-1, 3),
+        "tri_loops": tri_loops.reshape(-1, 3),
+        "tri_mats": tri_mats,
+    }
+
+
+def transform_arrays(arrays, matrix):
+    """Apply a 4x4 transform, in place, to the positions and normals returned by :func:`mesh_arrays`"""
+    m = np.array(matrix, dtype=np.float32)
+    linear = m[:3, :3]
+
+    arrays["co"] = arrays["co"] @ linear.T + m[:3, 3]
+
+    # normals transform by the inverse transpose
+    normals = arrays["normals"] @ np.linalg.pinv(linear)
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    arrays["normals"] = normals / np.maximum(lengths, 1e-12)
+
+    # keep the faces facing outwards for mirroring transforms
+    if np.linalg.det(linear) < 0:
+        arrays["tri_verts"] = arrays["tri_verts"][:, ::-1]
+        arrays["tri_loops"] = arrays["tri_loops"][:, ::-1]
+
+
+def format_rows(line, rows, index=None):
+    """
+    Format each row of a NumPy array with the printf-style line, ROWS_PER_BLOCK rows at a time.
+
+    index : if given, format ``rows[index]`` instead, without gathering all of it at once
+
+    Yields one string per block, so no more than a block's worth of Python floats and text exists at a time.
+    """
+    count = len(rows) if index is None else len(index)
+    for start in range(0, count, ROWS_PER_BLOCK):
+        block = slice(start, start + ROWS_PER_BLOCK)
+        block_rows = rows[block] if index is None else rows[index[block]]
+        yield (line * len(block_rows)) % tuple(block_rows.ravel().tolist())
+
+
+def format_obj(chunks, mtl_name=None):
+    """
+    Format a list of ``(name, arrays, material_names)`` chunks as the text of a single OBJ file.
+
+    Yields the text one block of at most ROWS_PER_BLOCK lines at a time (see :func:`format_rows`), so that
+    it can be written out without ever holding the (potentially huge) file contents in memory.
+
+    arrays : as returned by :func:`mesh_arrays`
+    material_names : the Darts material name (or None) for each material index, or None to skip 'usemtl' statements
+    """
+    if mtl_name is not None:
+        yield f"mtllib {mtl_name}\n"
+
+    # OBJ indices are global and 1-based
+    v_offset = vt_offset = vn_offset = 1
+    for name, arrays, material_names in chunks:
+        co = arrays["co"]
+        normals = arrays["normals"]
+        uvs = arrays["uvs"]
+        colors = arrays["colors"]
+
+        yield f"o {name}\n"
+        if colors is None:
+            yield from format_rows("v %.6f %.6f %.6f\n", co)
+        else:
+            yield from format_rows("v %.6f %.6f %.6f %.4f %.4f %.4f\n", np.hstack((co, colors)))
+        if uvs is not None:
+            yield from format_rows("vt %.6f %.6f\n", uvs)
+        yield from format_rows("vn %.4f %.4f %.4f\n", normals)
+
+        verts = arrays["tri_verts"] + v_offset
+        if uvs is not None:
+            face = "f %d/%d/%d %d/%d/%d %d/%d/%d\n"
+            corners = np.stack((verts, arrays["tri_loops"] + vt_offset, arrays["tri_loops"] + vn_offset), axis=-1)
+        else:
+            face = "f %d//%d %d//%d %d//%d\n"
+            corners = np.stack((verts, arrays["tri_loops"] + vn_offset), axis=-1)
+
+        # emit the faces grouped by material
+        tri_mats = arrays["tri_mats"]
+        order = np.argsort(tri_mats, kind="stable")
+        mats, starts = np.unique(tri_mats[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        for m, start, end in zip(mats.tolist(), starts.tolist(), ends.tolist()):
+            if material_names is not None:
+                # faces without a material would otherwise inherit the previous 'usemtl'
+                name = material_names[m] if m < len(material_names) else None
+                yield f"usemtl {name or 'default'}\n"
+            yield from format_rows(face, corners, order[start:end])
+
+        v_offset += len(co)
+        vn_offset += len(normals)
+        if uvs is not None:
+            vt_offset += len(uvs)
+
+
+def format_mtl(b_materials):
+    """Format a minimal MTL file with the diffuse color of each ``(name, material)`` pair"""
+    out = []
+    for name, b_mat in b_materials:
+        r, g, b = b_mat.diffuse_color[:3]
+        out.append(f"newmtl {name}\nKd {r:.6f} {g:.6f} {b:.6f}\n\n")
+    return "".join(out)
+
+
+# (viewport, render) settings of object data whose render value replaces the viewport one while
+# exporting with the render settings. A render resolution of 0 means "same as the viewport"
+DATA_RENDER_SETTINGS = {
+    "CURVE": (("resolution_u", "render_resolution_u"),),
+    "SURFACE": (("resolution_u", "render_resolution_u"), ("resolution_v", "render_resolution_v")),
+    "FONT": (("resolution_u", "render_resolution_u"),),
+    "META": (("resolution", "render_resolution"),),
+}
+
+# The bpy.data collection holding the object data of the types in DATA_RENDER_SETTINGS
+DATA_COLLECTIONS = {"CURVE": "curves", "SURFACE": "curves", "FONT": "curves", "META": "metaballs"}
+
+
+def id_ref(datablock):
+    """A (name, library) handle on a datablock, to look it up again with bpy.data.<collection>.get()"""
+    return (datablock.name, None if datablock.library is None else datablock.library.filepath)
+
+
+def use_render_settings(ctx, depsgraph, objects):
+    """
+    Switch the modifiers (and curve/metaball resolutions) of the given objects to their render settings,
+    the way Blender evaluates them for a final render, and re-evaluate the depsgraph once.
+
+    Switches in geometry nodes (e.g. the 'Is Viewport' node) can't be overridden this way.
+
+    Returns the overrides to pass on to :func:`restore_settings`. They refer to their modifiers and object data
+    by name, since they stay in place over the whole (modal) mesh export.
+    """
+    overrides = []
+
+    def override(owner, owner_ref, attribute, value):
+        viewport_value = getattr(owner, attribute)
+        if viewport_value == value:
+            return
+        try:
+            setattr(owner, attribute, value)
+        except AttributeError:
+            # e.g. linked library data, which can't be edited
+            ctx.info(f"  Cannot change '{owner.name}.{attribute}', exporting its viewport setting.")
+            return
+        overrides.append((owner_ref, attribute, viewport_value))
+
+    for object in objects:
+        for modifier in object.modifiers:
+            modifier_ref = ("modifier", id_ref(object), modifier.name)
+            override(modifier, modifier_ref, "show_viewport", modifier.show_render)
+            # subdivision surface and multiresolution modifiers
+            if hasattr(modifier, "render_levels"):
+                override(modifier, modifier_ref, "levels", modifier.render_levels)
+
+        for viewport, render in DATA_RENDER_SETTINGS.get(object.type, ()):
+            render_value = getattr(object.data, render)
+            if render_value:
+                data_ref = ("data", DATA_COLLECTIONS[object.type], id_ref(object.data))
+                override(object.data, data_ref, viewport, render_value)
+
+    if overrides:
+        depsgraph.update()
+
+    return overrides
+
+
+def restore_settings(overrides):
+    """Undo the overrides made by :func:`use_render_settings`, skipping anything removed in the meantime"""
+    for (kind, *ref), attribute, viewport_value in reversed(overrides):
+        if kind == "modifier":
+            object_ref, modifier_name = ref
+            object = bpy.data.objects.get(object_ref)
+            owner = None if object is None else object.modifiers.get(modifier_name)
+        else:
+            collection, data_ref = ref
+            owner = getattr(bpy.data, collection).get(data_ref)
+        if owner is not None:
+            setattr(owner, attribute, viewport_value)
+
+
+def extract_obj(ctx, depsgraph, objects, world_space=True):
+    """
+    Gather everything needed to write the evaluated geometry of the given Blender objects to a single OBJ file.
+
+    Instead of going through Blender's OBJ export operator, we pull the mesh data out with
+    foreach_get into NumPy arrays and format the OBJ text ourselves in :func:`write_obj_file`.
+    This part accesses Blender data, so it must run on the main thread.
+
+    world_space : if False, write each mesh in its object's local coordinates
+
+    Returns the ``(chunks, mtl_text)`` to pass on to write_obj_file. mtl_text is None if materials are off.
+    """
+    use_materials = ctx.material_mode != "OFF"
+
+    material_name = ctx.material_name
+    chunks = []
+    b_materials = {}
+
+    # objects without modifiers that share mesh data (e.g. linked duplicates) have identical local
+    # geometry, so it only needs to be converted and triangulated once
+    shared_arrays = {}
+    for object in objects:
+        eval_obj = object.evaluated_get(depsgraph)
+        key = None if object.data is None or len(object.modifiers) > 0 else object.data.as_pointer()
+        arrays = shared_arrays.get(key)
+
+        if arrays is None:
+            try:
+                mesh = eval_obj.to_mesh()
+            except RuntimeError:
+                mesh = None
+            if mesh is None:
+                continue
+
+            try:
+                arrays = mesh_arrays(mesh)
+            finally:
+                eval_obj.to_mesh_clear()
+
+            if key is not None:
+                shared_arrays[key] = arrays
+
+        # transform_arrays replaces the entries of the dict, so give each object its own
+        arrays = dict(arrays)
+        if world_space:
+            transform_arrays(arrays, eval_obj.matrix_world)
+
+        material_names = None
+        if use_materials:
+            material_names = []
+            for slot in object.material_slots:
+                if slot.material is None:
+                    material_names.append(None)
+                    continue
+                name = material_name(slot.material.name_full)
+                b_materials[name] = slot.material
+                material_names.append(name)
+
+        chunks.append((object.name, arrays, material_names))
+
+    return chunks, format_mtl(b_materials.items()) if use_materials else None
+
+
+def write_obj_file(filepath, chunks, mtl_text):
+    """
+    Format and write an OBJ file (and its MTL file, if mtl_text is not None) gathered by :func:`extract_obj`.
+
+    This only touches NumPy arrays and the file system, so it is safe to run on a worker thread.
+    """
+    base, _ = os.path.splitext(filepath)
+    mtl_path = base + ".mtl"
+    with open(filepath, "wb", buffering=WRITE_BUFFER_SIZE) as obj_file:
+        for block in format_obj(chunks, None if mtl_text is None else os.path.basename(mtl_path)):
+            obj_file.write(block.encode("utf-8"))
+
+    if mtl_text is not None:
+        with open(mtl_path, "wb", buffering=WRITE_BUFFER_SIZE) as mtl_file:
+            mtl_file.write(mtl_text.encode("utf-8"))
+
+
+def write_obj(ctx, depsgraph, objects, obj_name, world_space=True, submit=None):
+    """
+    Export meshes to "meshes/" and then point to them in the scene file
+
+    submit : if given, pass it the arguments for :func:`write_obj_file` instead of writing the file
+    """
+
+    # the scene file always uses forward slashes, so the relative path doubles as the OBJ's
+    # id and its "filename"; only the path on disk needs to go through os.path
+    relative_path = f"meshes/{obj_name}.obj"
+
+    # skip if we've already exported this object. Return a copy, since callers add per-instance fields
     obj_id = f"obj-{relative_path}"
-    if obj_id in ctx.already_exported.keys():
-        ctx.report({"WARNING"}, f"Exporting OBJ file '{relative_path}' again!")
+    if obj_id in ctx.already_exported:
+        ctx.info(f"  Skipping previously exported OBJ file '{relative_path}'.")
+        return dict(ctx.already_exported[obj_id])
 
     if ctx.write_obj_files:
-        if bpy.app.version >= (3, 3, 0):
-            # new, faster C++ OBJ exporter
-            ctx.info(f"  Writing '{relative_path}' using C++ exporter.")
-            bpy.ops.wm.obj_export(
-                filepath=os.path.join(ctx.directory, relative_path),
-                export_selected_objects=True,
-                export_eval_mode="DAG_EVAL_RENDER",
-                apply_modifiers=True,
-                export_normals=True,
-                export_colors=True,
-                export_uv=True,
-                export_materials=ctx.material_mode != "OFF",
-                export_triangulated_mesh=True,
-                check_existing=False,
-                forward_axis="Y",
-                up_axis="Z",
-            )
+        ctx.info(f"  Writing '{relative_path}'.")
+        filepath = os.path.join(ctx.directory, "meshes", obj_name + ".obj")
+        job = (filepath, *extract_obj(ctx, depsgraph, objects, world_space))
+        if submit is None:
+            write_obj_file(*job)
         else:
-            # legacy python exporter
-            ctx.info(f"  Writing '{relative_path}' using legacy Python exporter.")
-            bpy.ops.export_scene.obj(
-                filepath=os.path.join(ctx.directory, relative_path),
-                use_selection=True,
-                use_mesh_modifiers=True,
-                use_normals=True,
-                use_uvs=True,
-                use_materials=ctx.material_mode != "OFF",
-                use_triangles=True,
-                use_edges=False,
-                use_smooth_groups=False,
-                check_existing=False,
-                axis_forward="Y",
-                axis_up="Z",
-            )
+            submit(*job)
 
     obj_params = {
         "type": "mesh",
         "name": obj_name,
-        "filename": f"meshes/{obj_name}.obj",
+        "filename": relative_path,
         "material": "default",
         "vertex colorspace": "srgb",
     }
@@ -63,62 +386,92 @@ def write_obj(ctx, obj_name):
     return obj_params
 
 
-def write_meshes(ctx, meshes, obj_name):
+def instancing_key(object):
+    """
+    Return a key that is shared by all objects whose local-space geometry and materials are identical,
+    or None if the object's geometry may be unique to it.
+    """
+    # modifiers (and geometry nodes) are evaluated per object, so only unmodified objects can share data.
+    # The key outlives the object in a modal export, so it uses session UIDs rather than pointers
+    if object.data is None or len(object.modifiers) > 0:
+        return None
+    return (
+        object.data.session_uid,
+        tuple(0 if slot.material is None else slot.material.session_uid for slot in object.material_slots),
+    )
 
-    # first, save the selection, then select the single mesh we want to export
-    viewport_selection = ctx.context.selected_objects
-    bpy.ops.object.select_all(action="DESELECT")
 
-    for mesh in meshes:
-        mesh.select_set(True)
-
-    obj_json = write_obj(ctx, obj_name)
+def export(ctx, objects):
+    """
+    Write the meshes of the given objects (:meth:`SceneWriter.object_ref` handles) and return their Darts surfaces.
 
-    # Now restore the previous selection
-    bpy.ops.object.select_all(action="DESELECT")
-    for ob in viewport_selection:
-        ob.select_set(True)
+    This is a generator: in SPLIT mode it yields the fraction of the objects done after each one, so that
+    the modal export operator can hand control back to Blender in between.
+    """
+    os.makedirs(os.path.join(ctx.directory, "meshes"), exist_ok=True)
 
-    return obj_json
+    # switch every exported object to its render settings once for the whole stage: switching them
+    # per object would re-evaluate the depsgraph for each object, and again when restoring it
+    overrides = []
+    if ctx.use_render_settings and ctx.write_obj_files:
+        found = [o for o in map(bpy.data.objects.get, objects) if o is not None]
+        overrides = use_render_settings(ctx, ctx.context.evaluated_depsgraph_get(), found)
+    try:
+        return (yield from export_surfaces(ctx, objects))
+    finally:
+        restore_settings(overrides)
 
 
-def export(ctx, objects):
-    if not os.path.exists(ctx.directory + "/meshes"):
-        os.makedirs(ctx.directory + "/meshes")
-
+def export_surfaces(ctx, objects):
+    """The body of :func:`export`, which runs with the render settings in place"""
     surfaces_json = []
     if ctx.mesh_mode == "SINGLE":
         ctx.info("Exporting a single scene-wide OBJ file.")
         obj_name, _ = os.path.splitext(ctx.filepath)
         obj_name = os.path.basename(obj_name)
-        surfaces_json.append(write_meshes(ctx, objects, obj_name))
+        depsgraph = ctx.context.evaluated_depsgraph_get()
+        surfaces_json.append(write_obj(ctx, depsgraph, ctx.resolve_objects(objects), obj_name))
     else:
         ctx.info("Exporting each Blender object as a separate OBJ file.")
-        for object in objects:
-
-            # write_obj by default exports meshes in world coordinates
-            # to save in local coordinates we temporarily transform all vertices by the inverse of matrix_world
-            to_world = object.matrix_world.copy()
+        transform_matrix = ctx.transform_matrix
+        append = surfaces_json.append
 
-            # save and turn off constraints
-            influences = []
-            for i, c in enumerate(object.constraints):
-                influences.append(c.influence)
-                c.influence = 0.0
+        # Blender data can only be accessed from the main thread, but once the geometry of an object
+        # has been extracted, its OBJ file can be formatted and written on a worker thread. This overlaps
+        # with extracting the next objects (and with Blender, between the steps of a modal export)
+        workers = os.cpu_count() or 1
+        pending = deque()
 
-            object.matrix_world.identity()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
 
-            bpy.context.view_layer.update()
+            def submit(*job):
+                # wait for the oldest writes (raising their errors here) rather than queueing up
+                # the arrays of every mesh in the scene
+                while len(pending) >= workers * PENDING_WRITES_PER_WORKER:
+                    pending.popleft().result()
+                pending.append(executor.submit(write_obj_file, *job))
 
-            params = write_meshes(ctx, [object], object.name)
-            params["transform"] = ctx.transform_matrix(to_world)
+            # objects that share mesh data (e.g. linked duplicates) share a single OBJ file,
+            # named after the first such object
+            obj_names = {}
+            for i, ref in enumerate(objects):
+                # the scene may have changed since the previous object, so look everything up again
+                object = ctx.resolve_object(ref)
+                if object is not None:
+                    depsgraph = ctx.context.evaluated_depsgraph_get()
+                    key = instancing_key(object)
+                    obj_name = object.name if key is None else obj_names.setdefault(key, object.name)
 
-            object.matrix_world = to_world
-            for i, c in enumerate(object.constraints):
-                c.influence = influences[i]
+                    # write the mesh in local coordinates, and place it in the scene with its world transform
+                    params = write_obj(ctx, depsgraph, [object], obj_name, world_space=False, submit=submit)
+                    params["name"] = object.name
+                    params["transform"] = transform_matrix(object.matrix_world)
+                    append(params)
 
-            bpy.context.view_layer.update()
+                yield (i + 1) / len(objects)
 
-            surfaces_json.append(params)
+            # raise any errors from the remaining writes here
+            while pending:
+                pending.popleft().result()
 
     return surfaces_json
@@ -11,6 +11,17 @@ RoughnessMode = {
 }
 
 
+def input_names(ctx, node):
+    """
+    The names of a node's input sockets, which are fixed by its node type
+    """
+    names = ctx.node_inputs.get(node.bl_idname)
+    if names is None:
+        names = frozenset(i.name for i in node.inputs)
+        ctx.node_inputs[node.bl_idname] = names
+    return names
+
+
 def make_two_sided(ctx, bsdf):
     if ctx.force_two_sided:
         ctx.info(f"  Wrapping '{bsdf['type']}' material in a 'two sided' adapter.")
@@ -37,54 +48,41 @@ def convert_glossy_material(ctx, node):
     Python API: https://docs.blender.org/api/latest/bpy.types.ShaderNodeBsdfAnisotropic.html
     User docs: https://docs.blender.org/manual/en/latest/render/shader_nodes/shader/glossy.html
     """
-    params = {}
+    inputs = node.inputs
+    roughness_input = inputs["Roughness"]
+    roughness_linked = roughness_input.is_linked
+    roughness_value = roughness_input.default_value
 
-    roughness = textures.convert_texture_node(ctx, node.inputs["Roughness"])
+    roughness = textures.convert_texture_node(ctx, roughness_input)
+    color = textures.convert_texture_node(ctx, inputs["Color"])
 
-    if ctx.glossy_mode == "rough conductor":
-        if node.distribution == "SHARP" or (
-            not node.inputs["Roughness"].is_linked
-            and node.inputs["Roughness"].default_value <= 0
-        ):
-            params.update({"type": "conductor"})
-        else:
-            params.update(
-                {
-                    "type": ctx.glossy_mode,
-                    "distribution": RoughnessMode[node.distribution],
-                }
-            )
+    mode = ctx.glossy_mode
+    is_sharp = node.distribution == "SHARP"
+    distribution = RoughnessMode.get(node.distribution)
 
-            params.update(
-                {
-                    "roughness": roughness,
-                }
-            )
-            if "Anisotropy" in node.inputs:
-                params.update(
-                    {
-                        "anisotropy": textures.convert_texture_node(
-                            ctx, node.inputs["Anisotropy"]
-                        ),
-                    }
+    params = {}
+    if mode == "rough conductor":
+        if is_sharp or (not roughness_linked and roughness_value <= 0):
+            params = {"type": "conductor", "color": color}
+        else:
+            params = {
+                "type": mode,
+                "distribution": distribution,
+                "roughness": roughness,
+                "color": color,
+            }
+            names = input_names(ctx, node)
+            if "Anisotropy" in names:
+                params["anisotropy"] = textures.convert_texture_node(
+                    ctx, inputs["Anisotropy"]
                 )
-            if "Rotation" in node.inputs:
-                params.update(
-                    {
-                        "rotation": textures.convert_texture_node(
-                            ctx, node.inputs["Rotation"]
-                        ),
-                    }
+            if "Rotation" in names:
+                params["rotation"] = textures.convert_texture_node(
+                    ctx, inputs["Rotation"]
                 )
 
-        params.update(
-            {
-                "color": textures.convert_texture_node(ctx, node.inputs["Color"]),
-            }
-        )
-
-    elif ctx.glossy_mode == "blinn-phong" or ctx.glossy_mode == "phong":
-        if node.inputs["Roughness"].is_linked:
+    elif mode in ("blinn-phong", "phong"):
+        if roughness_linked:
             raise NotImplementedError(
                 "Phong and Blinn-Phong roughness parameter doesn't support textures in Darts"
             )
@@ -93,40 +91,25 @@ def convert_glossy_material(ctx, node):
             def roughness_to_blinn_exponent(alpha):
                 return max(2.0 / (alpha * alpha) - 1.0, 0.0)
 
-            exponent = roughness_to_blinn_exponent(
-                pow(node.inputs["Roughness"].default_value, 2)
-            )
-            if ctx.glossy_mode == "phong":
+            exponent = roughness_to_blinn_exponent(pow(roughness_value, 2))
+            if mode == "phong":
                 exponent = exponent / 4
 
-        if node.distribution == "SHARP" or exponent <= 0:
-            params.update({"type": "metal", "roughness": 0})
+        if is_sharp or exponent <= 0:
+            params = {"type": "metal", "roughness": 0, "color": color}
         else:
-            params.update(
-                {
-                    "type": ctx.glossy_mode,
-                    "exponent": exponent,
-                    "distribution": RoughnessMode[node.distribution],
-                }
-            )
-
-        params.update(
-            {
-                "color": textures.convert_texture_node(ctx, node.inputs["Color"]),
+            params = {
+                "type": mode,
+                "exponent": exponent,
+                "distribution": distribution,
+                "color": color,
             }
-        )
-    elif ctx.glossy_mode == "metal":
-        params.update(
-            {
-                "type": ctx.glossy_mode,
-                "roughness": (
-                    textures.convert_texture_node(ctx, node.inputs["Roughness"])
-                    if node.distribution != "SHARP"
-                    else 0
-                ),
-                "color": textures.convert_texture_node(ctx, node.inputs["Color"]),
-            }
-        )
+    elif mode == "metal":
+        params = {
+            "type": mode,
+            "roughness": 0 if is_sharp else roughness,
+            "color": color,
+        }
 
     return make_two_sided(ctx, params)
 
@@ -138,22 +121,26 @@ def convert_glass_material(ctx, node):
     """
     params = {}
 
-    if node.inputs["IOR"].is_linked:
+    inputs = node.inputs
+    ior_input = inputs["IOR"]
+
+    if ior_input.is_linked:
         ctx.report(
             {"WARNING"},
             f"{node.name}: Textured IOR values are not supported in Darts. Using the default value instead.",
         )
 
-    ior = node.inputs["IOR"].default_value
+    ior = ior_input.default_value
 
-    roughness = textures.convert_texture_node(ctx, node.inputs["Roughness"])
+    roughness = textures.convert_texture_node(ctx, inputs["Roughness"])
 
-    if roughness and node.distribution != "SHARP":
+    distribution = node.distribution
+    if roughness and distribution != "SHARP":
         params.update(
             {
                 "type": "rough dielectric",
                 "roughness": roughness,
-                "distribution": RoughnessMode[node.distribution],
+                "distribution": RoughnessMode[distribution],
             }
         )
     else:
@@ -161,7 +148,7 @@ def convert_glass_material(ctx, node):
 
     params["ior"] = ior
     params["reflectance"] = params["transmittance"] = textures.convert_texture_node(
-        ctx, node.inputs["Color"]
+        ctx, inputs["Color"]
     )
 
     return params
@@ -172,19 +159,22 @@ def convert_emission_material(ctx, node):
     Python API: https://docs.blender.org/api/latest/bpy.types.ShaderNodeEmission.html
     User docs: https://docs.blender.org/manual/en/latest/render/shader_nodes/shader/emission.html
     """
-    if node.inputs["Strength"].is_linked:
+    strength_input = node.inputs["Strength"]
+    color_input = node.inputs["Color"]
+
+    if strength_input.is_linked:
         raise NotImplementedError("Only default emitter strength value is supported")
     else:
-        radiance = node.inputs["Strength"].default_value
+        radiance = strength_input.default_value
 
-    if node.inputs["Color"].is_linked:
+    if color_input.is_linked:
         raise NotImplementedError(
             "Only default emitter color is supported"
         )  # TODO: rgb input
     else:
-        radiance = [x * radiance for x in node.inputs["Color"].default_value[:]]
+        radiance = [x * radiance for x in color_input.default_value[:]]
 
-    if np.sum(radiance) == 0:
+    if not any(radiance):
         ctx.report(
             {"WARN"},
             "  Emitter has zero emission, this may cause Darts to fail! Creating a 'diffuse' material instead.",
@@ -213,11 +203,13 @@ def convert_mix_material(ctx, node):
     Python API: https://docs.blender.org/api/latest/bpy.types.ShaderNodeMixShader.html
     User docs: https://docs.blender.org/manual/en/latest/render/shader_nodes/shader/mix.html
     """
-    if not node.inputs[1].is_linked or not node.inputs[2].is_linked:
+    shader_I = node.inputs[1]
+    shader_II = node.inputs[2]
+    if not (shader_I.is_linked and shader_II.is_linked):
         raise NotImplementedError("Mix shader is not linked to two materials")
 
-    mat_I = ctx.follow_link(node.inputs[1]).links[0].from_node
-    mat_II = ctx.follow_link(node.inputs[2]).links[0].from_node
+    mat_I = ctx.follow_link(shader_I).links[0].from_node
+    mat_II = ctx.follow_link(shader_II).links[0].from_node
 
     return {
         "type": "mix",
@@ -232,11 +224,13 @@ def convert_add_material(ctx, node):
     Python API: https://docs.blender.org/api/latest/bpy.types.ShaderNodeAddShader.html
     User docs: https://docs.blender.org/manual/en/latest/render/shader_nodes/shader/add.html
     """
-    if not node.inputs[1].is_linked or not node.inputs[2].is_linked:
+    shader_I = node.inputs[1]
+    shader_II = node.inputs[2]
+    if not (shader_I.is_linked and shader_II.is_linked):
         raise NotImplementedError("Add shader is not linked to two materials")
 
-    mat_I = ctx.follow_link(node.inputs[1]).links[0].from_node
-    mat_II = ctx.follow_link(node.inputs[2]).links[0].from_node
+    mat_I = ctx.follow_link(shader_I).links[0].from_node
+    mat_II = ctx.follow_link(shader_II).links[0].from_node
 
     return {
         "type": "add",
@@ -246,12 +240,12 @@ def convert_add_material(ctx, node):
 
 
 def wrap_with_bump_or_normal_map(ctx, node, nested):
-    if (
-        (ctx.use_normal_maps or ctx.use_bump_maps)
-        and "Normal" in node.inputs
-        and node.inputs["Normal"].is_linked
-    ):
-        n = ctx.follow_link(node.inputs["Normal"]).links[0].from_node
+    if not ctx.use_surface_wrappers or "Normal" not in input_names(ctx, node):
+        return nested
+
+    normal_input = node.inputs["Normal"]
+    if normal_input.is_linked:
+        n = ctx.follow_link(normal_input).links[0].from_node
 
         if n.bl_idname == "ShaderNodeNormalMap":
             if not ctx.use_normal_maps:
@@ -297,21 +291,21 @@ def convert_volume_scatter_node(ctx, node):
     Python API: https://docs.blender.org/api/latest/bpy.types.ShaderNodeVolumeScatter.html
     User docs: https://docs.blender.org/manual/en/latest/render/shader_nodes/shader/volume_scatter.html
     """
-    if (
-        node.inputs["Color"].is_linked
-        or node.inputs["Density"].is_linked
-        or node.inputs["Anisotropy"].is_linked
-    ):
+    color_input = node.inputs["Color"]
+    density_input = node.inputs["Density"]
+    anisotropy_input = node.inputs["Anisotropy"]
+
+    if color_input.is_linked or density_input.is_linked or anisotropy_input.is_linked:
         raise NotImplementedError(
             "Only homogeneous volume scattering nodes are currently supported"
         )
 
     return {
         "type": "homogeneous",
-        "albedo": ctx.color(node.inputs["Color"].default_value),
-        "total": ctx.color(node.inputs["Density"].default_value),
+        "albedo": ctx.color(color_input.default_value),
+        "total": ctx.color(density_input.default_value),
         "real fraction": 1.0,
-        "phase function": {"type": "hg", "g": node.inputs["Anisotropy"].default_value},
+        "phase function": {"type": "hg", "g": anisotropy_input.default_value},
     }
 
 
@@ -320,18 +314,20 @@ def convert_volume_absorption_node(ctx, node):
     Python API: https://docs.blender.org/api/latest/bpy.types.ShaderNodeVolumeAbsorption.html
     User docs: https://docs.blender.org/manual/en/latest/render/shader_nodes/shader/volume_absorption.html
     """
-    if node.inputs["Color"].is_linked or node.inputs["Density"].is_linked:
+    color_input = node.inputs["Color"]
+
+    if color_input.is_linked or node.inputs["Density"].is_linked:
         raise NotImplementedError(
             "Only homogeneous volume absorption nodes are currently supported"
         )
 
+    # darker colors absorb more; the alpha channel is not part of the coefficient
+    total = [max(1.0 - max(c, 0.0) ** 0.5, 0.0) for c in color_input.default_value[:3]]
+
     return {
         "type": "homogeneous",
         "albedo": 0,
-        "total": [
-            max(1.0 - pow(max(x, 0.0), 0.5))
-            for x in node.inputs["Color"].default_value[:]
-        ],
+        "total": total,
         "real fraction": 1.0,
         "phase function": {"type": "isotropic"},
     }
@@ -345,69 +341,72 @@ def convert_volume_vdb_node(ctx, node):
 
     ctx.info(f"Converting vdb node")
 
-    if (
-        node.inputs["Color"].is_linked
-        or node.inputs["Density"].is_linked
-        or node.inputs["Absorption Color"].is_linked
-    ):
+    inputs = node.inputs
+    color_input = inputs["Color"]
+    density_input = inputs["Density"]
+    absorption_input = inputs["Absorption Color"]
+
+    if color_input.is_linked or density_input.is_linked or absorption_input.is_linked:
         raise NotImplementedError(
             "Textured density, color, or absorption colors are not supported by the nanovdb medium"
         )
 
     # map Blender colors to RTE coefficients
-    scatter_color = np.array(ctx.color(node.inputs["Color"].default_value))
-    absorption_color = np.array(
-        ctx.color(node.inputs["Absorption Color"].default_value)
-    )
-    absorption_coeff = np.maximum(1.0 - scatter_color, 0.0) * np.maximum(
-        1.0 - absorption_color, 0.0
-    )
+    scatter_color = ctx.color(color_input.default_value)
+    absorption_color = ctx.color(absorption_input.default_value)
+    absorption_coeff = [
+        max(1.0 - s, 0.0) * max(1.0 - a, 0.0)
+        for s, a in zip(scatter_color, absorption_color)
+    ]
 
     params = {
         "type": "nanovdb",
-        "density": node.inputs["Density"].default_value,
-        "sigma_s": scatter_color.tolist(),
-        "sigma_a": absorption_coeff.tolist(),
-        "phase function": {"type": "hg", "g": node.inputs["Anisotropy"].default_value},
+        "density": density_input.default_value,
+        "sigma_s": scatter_color,
+        "sigma_a": absorption_coeff,
+        "phase function": {"type": "hg", "g": inputs["Anisotropy"].default_value},
     }
 
-    if node.inputs["Density Attribute"]:
-        params["gridname"] = node.inputs["Density Attribute"].default_value
+    density_attribute = inputs["Density Attribute"]
+    if density_attribute:
+        params["gridname"] = density_attribute.default_value
 
     return params
 
 
-def cycles_volume_to_dict(ctx, node, name=None):
-    """Converting one Cycles volume shader to a Darts medium"""
-
-    ctx.info("Adding volume")
-
-    cycles_converters = {
+volume_converters = textures.by_node_class(
+    {
         "ShaderNodeVolumeScatter": convert_volume_scatter_node,
         "ShaderNodeVolumeAbsorption": convert_volume_absorption_node,
         "ShaderNodeVolumePrincipled": convert_volume_vdb_node,
     }
+)
+
+
+def cycles_volume_to_dict(ctx, node, name=None):
+    """Converting one Cycles volume shader to a Darts medium"""
+
+    ctx.info("Adding volume")
 
     params = {}
     if name is not None:
         params["name"] = ctx.material_name(name)
 
-    if node.bl_idname in cycles_converters:
-        ctx.info(f"Converting a '{node.bl_idname}' Blender volume.")
-        params.update(cycles_converters[node.bl_idname](ctx, node))
-        ctx.info(f"  Created a '{params['type']}' medium.")
-    else:
+    converter = volume_converters.get(type(node))
+    if converter is None:
         raise NotImplementedError(
             f"Node type: {node.bl_idname} is not supported in Darts"
         )
 
+    ctx.info(f"Converting a '{node.bl_idname}' Blender volume.")
+    params.update(converter(ctx, node))
+    ctx.info(f"  Created a '{params['type']}' medium.")
+
     return params
 
 
-def cycles_surface_to_dict(ctx, node, name=None):
-    """Converting a Blender surface node to Darts material format"""
-
-    cycles_converters = {
+surface_converters = textures.by_node_class(
+    {
         "ShaderNodeBsdfDiffuse": convert_diffuse_material,
         "ShaderNodeBsdfGlossy": convert_glossy_material,
         "ShaderNodeBsdfAnisotropic": convert_glossy_material,
@@ -417,21 +416,36 @@ def cycles_surface_to_dict(ctx, node, name=None):
         "ShaderNodeEmission": convert_emission_material,
         "ShaderNodeBsdfTransparent": convert_transparent_material,
     }
+)
+
+
+def cycles_surface_to_dict(ctx, node, name=None):
+    """Converting a Blender surface node to Darts material format"""
+
+    # unnamed surfaces are nested inside mix/add shaders, where the same node can be reached
+    # along several paths
+    key = node.as_pointer()
+    if name is None and key in ctx.converted_surfaces:
+        return ctx.converted_surfaces[key]
 
     params = {}
     if name is not None:
         params["name"] = ctx.material_name(name)
 
-    if node.bl_idname in cycles_converters:
-        ctx.info(f"Converting a '{node.bl_idname}' Blender material.")
-        params.update(cycles_converters[node.bl_idname](ctx, node))
-        ctx.info(f"  Created a '{params['type']}' material.")
-    else:
+    converter = surface_converters.get(type(node))
+    if converter is None:
         raise NotImplementedError(
             f"Node type: {node.bl_idname} is not supported in Darts"
         )
 
-    return wrap_with_bump_or_normal_map(ctx, node, params)
+    ctx.info(f"Converting a '{node.bl_idname}' Blender material.")
+    params.update(converter(ctx, node))
+    ctx.info(f"  Created a '{params['type']}' material.")
+
+    params = wrap_with_bump_or_normal_map(ctx, node, params)
+    if name is None:
+        ctx.converted_surfaces[key] = params
+    return params
 
 
 def get_dummy_material(ctx, name):
@@ -451,38 +465,27 @@ def convert_material(ctx, b_mat):
 
     if b_mat.use_nodes:
         try:
-            output_node_id = "Material Output"
-            if output_node_id not in b_mat.node_tree.nodes:
+            output_node = b_mat.node_tree.nodes.get("Material Output")
+            if output_node is None:
                 raise NotImplementedError("Cannot find material output node")
 
-            output_node = b_mat.node_tree.nodes[output_node_id]
-
-            if (
-                "Surface" in output_node.inputs
-                and output_node.inputs["Surface"].is_linked
-            ):
-                surface_node = (
-                    ctx.follow_link(output_node.inputs["Surface"]).links[0].from_node
-                )
+            inputs = output_node.inputs
+            surface = inputs.get("Surface")
+            if surface is not None and surface.is_linked:
+                surface_node = ctx.follow_link(surface).links[0].from_node
                 mat_params = cycles_surface_to_dict(ctx, surface_node, b_mat.name_full)
             else:
                 mat_params = {"type": "transparent"}
 
-            if (
-                "Volume" in output_node.inputs
-                and output_node.inputs["Volume"].is_linked
-            ):
-                volume_node = (
-                    ctx.follow_link(output_node.inputs["Volume"]).links[0].from_node
-                )
+            volume = inputs.get("Volume")
+            if volume is not None and volume.is_linked:
+                volume_node = ctx.follow_link(volume).links[0].from_node
                 medium_name = b_mat.name_full + " volume"
                 media_params = cycles_volume_to_dict(ctx, volume_node, medium_name)
                 mat_params["interior medium"] = medium_name
 
-            if (
-                "Displacement" in output_node.inputs
-                and output_node.inputs["Displacement"].is_linked
-            ):
+            displacement = inputs.get("Displacement")
+            if displacement is not None and displacement.is_linked:
                 ctx.report(
                     {"WARNING"},
                     f"Material '{b_mat.name_full}': Displacement maps are not supported. Consider converting them to bump maps first",
@@ -501,7 +504,13 @@ def convert_material(ctx, b_mat):
 
 
 def export(ctx, meshes):
-    """Write out the materials to Darts format"""
+    """
+    Write out the materials of the given objects (:meth:`SceneWriter.object_ref` handles) to Darts format.
+
+    This is a generator: when converting materials, it yields the fraction of the objects done after each
+    one, so that the modal export operator can hand control back to Blender in between.
+    Returns the ``(materials, media)`` lists.
+    """
 
     ctx.info(f"Writing default diffuse material")
     materials = [{"type": "diffuse", "name": "default", "color": 0.2}]
@@ -519,38 +528,37 @@ def export(ctx, meshes):
             materials.append(params)
 
     elif ctx.material_mode == "CONVERT":
-        for mesh in meshes:
-            if not mesh.data or not mesh.data.materials:
-                continue
-            ctx.info(
-                f"Object '{mesh.name_full}' of type '{mesh.type}' has {len(mesh.data.materials)} materials."
-            )
-            for mat in mesh.data.materials:
-
-                # skip any materials that aren't being used
-                if not mat:
-                    continue
-                if mat.name_full == "Dots Stroke" or mat.users == 0:
-                    ctx.info(f"Skipping unused material '{mat.name_full}'")
-                    continue
-
-                # skip if we've already exported this material
-                mat_id = f"mat-{mat.name_full}"
-                if mat_id in ctx.already_exported.keys():
-                    ctx.info(
-                        f"Skipping previously exported material '{mat.name_full}'."
-                    )
-                    continue
-
+        # convert each used material once, however many meshes reference it. Nothing is held on to
+        # from one object to the next, since the scene may change in between
+        seen = set()
+        for i, ref in enumerate(meshes):
+            mesh = ctx.resolve_object(ref)
+            if mesh is not None and mesh.data and mesh.data.materials:
                 ctx.info(
-                    f"Exporting material '{mat.name_full}', with {mat.users} users."
+                    f"Object '{mesh.name_full}' of type '{mesh.type}' has {len(mesh.data.materials)} materials."
                 )
+                for mat in mesh.data.materials:
+                    # skip empty slots and anything we've already looked at
+                    if not mat:
+                        continue
+                    mat_id = ctx.export_key(mat)
+                    if mat_id in seen:
+                        continue
+                    seen.add(mat_id)
+
+                    # skip any materials that aren't being used
+                    if mat.name_full == "Dots Stroke" or mat.users == 0:
+                        ctx.info(f"Skipping unused material '{mat.name_full}'")
+                        continue
+
+                    ctx.info(f"Exporting material '{mat.name_full}', with {mat.users} users.")
+
+                    mat_params, media_params = convert_material(ctx, mat)
 
-                mat_params, media_params = convert_material(ctx, mat)
-                ctx.already_exported[mat_id] = mat_params
+                    materials.append(mat_params)
+                    if media_params:
+                        media.append(media_params)
 
-                materials.append(mat_params)
-                if media_params:
-                    media.append(media_params)
+            yield (i + 1) / len(meshes)
 
     return materials, media
@@ -1,15 +1,22 @@
+import io
 import os
 import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
 import bpy
 from mathutils import Matrix
 from mathutils import Vector
 from mathutils import Euler
 from mathutils import Quaternion
-from math import degrees
+from math import degrees, isfinite
 import json
 import numpy as np
-import pyopenvdb as vdb
+
+try:
+    # orjson is much faster at serializing large scenes, but is not bundled with Blender
+    import orjson
+except ImportError:
+    orjson = None
 
 from . import materials
 from . import textures
@@ -29,6 +36,103 @@ SUPPORTED_TYPES = {
 BLENDER_VERSION = f"{bpy.app.version[0]}.{bpy.app.version[1]}"
 
 
+def numpy_to_json(value):
+    """
+    default= hook for the stdlib json encoder, for the (rare) NumPy values in the scene dict.
+    float32 values are spelled as the float32 value, as orjson does
+    """
+    if isinstance(value, np.ndarray):
+        if value.dtype == np.float32:
+            value = value.astype(str).astype(np.float64)
+        return value.tolist()
+    if isinstance(value, np.float32):
+        return float(str(value))
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def orjson_compatible(value):
+    """
+    Copy the scene dict the way orjson sees it, for the stdlib json encoder: NumPy values become
+    plain lists and numbers (see :func:`numpy_to_json`), and non-finite floats become None, since
+    orjson writes them as null. Only needed when the scene contains non-finite floats
+    """
+    if isinstance(value, dict):
+        return {key: orjson_compatible(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [orjson_compatible(item) for item in value]
+    if isinstance(value, float):
+        return value if isfinite(value) else None
+    if isinstance(value, (np.ndarray, np.generic)):
+        return orjson_compatible(numpy_to_json(value))
+    return value
+
+
+def dump_json(data, file):
+    """
+    Write the scene dict as indented JSON to a binary file, using orjson if it is available.
+
+    Both paths write the same structure: two-space indentation, UTF-8 strings and null for non-finite floats.
+    The files are not byte-identical, since orjson and Python spell float exponents differently (1e-7 vs 1e-07)
+    """
+    if orjson is not None:
+        file.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+        return
+
+    # stream the encoder's output into the file rather than building the whole string first
+    text_file = io.TextIOWrapper(file, encoding="utf-8")
+    options = {"indent": 2, "ensure_ascii": False, "allow_nan": False}
+    try:
+        json.dump(data, text_file, default=numpy_to_json, **options)
+    except ValueError:
+        # a non-finite float: start over from a copy of the scene in which they are None, as orjson writes them
+        text_file.seek(0)
+        text_file.truncate()
+        json.dump(orjson_compatible(data), text_file, **options)
+    text_file.detach()
+
+
+def scaled_progress(steps, start, end):
+    """
+    Drive a generator that yields the fraction (0 to 1) of its own stage that is done, yielding it rescaled
+    to the [start, end] range of the whole export instead. Returns the stage's return value
+    """
+    try:
+        while True:
+            try:
+                fraction = next(steps)
+            except StopIteration as done:
+                return done.value
+            yield start + (end - start) * fraction
+    finally:
+        steps.close()
+
+
+def copy_file(source, directory):
+    """
+    Copy a file into a directory, letting the kernel move the data directly where the
+    platform supports it (copy_file_range on Linux), and falling back to shutil otherwise
+    """
+    target = os.path.join(directory, os.path.basename(source))
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(source, "rb") as src, open(target, "wb") as dst:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            return target
+        except OSError:
+            # e.g. not supported by the file system, start over with a regular copy
+            pass
+
+    shutil.copyfile(source, target)
+    return target
+
+
 class SceneWriter:
     """
     Writes a Blender scene to a Darts-compatible json scene file.
@@ -48,6 +152,7 @@ class SceneWriter:
         sampler,
         use_lights,
         mesh_mode,
+        use_render_settings,
         material_mode,
         glossy_mode,
         use_normal_maps,
@@ -74,9 +179,11 @@ class SceneWriter:
         enable_wave,
         enable_wavelength,
         enable_wireframe,
+        profile=False,
     ):
         self.context = context
         self.report = report
+        self.profile = profile
 
         self.write_obj_files = write_obj_files
 
@@ -89,11 +196,13 @@ class SceneWriter:
         self.use_lights = use_lights
 
         self.mesh_mode = mesh_mode
+        self.use_render_settings = use_render_settings
 
         self.material_mode = material_mode
         self.write_texture_files = write_texture_files
         self.use_normal_maps = use_normal_maps
         self.use_bump_maps = use_bump_maps
+        self.use_surface_wrappers = use_normal_maps or use_bump_maps
         self.force_two_sided = force_two_sided
         self.glossy_mode = glossy_mode
 
@@ -121,24 +230,73 @@ class SceneWriter:
 
         self.filepath = filepath
         self.directory = os.path.dirname(filepath)
+        # exported datablocks are keyed by export_key(), exported files by their relative path
         self.already_exported = {}
+        self.constant_values = {}
+        self.exported_images = {}
+        self.textures_folder_created = False
+        self.texture_manifest = None  # loaded along with the textures folder
+        self.texture_copies = []
+        self.texture_names = set()
+        self.image_textures = {}
+        self.converted_sockets = {}
+        self.converted_surfaces = {}
+        self.node_inputs = {}
         self.world_medium = None
+        self.world_output = False  # not looked up yet
 
     def info(self, message):
         if self.verbose:
             self.report({"INFO"}, message)
 
+    def export_key(self, datablock):
+        """
+        The already_exported key of a Blender datablock: its session UID, which is unique
+        for the lifetime of the Blender session and cheaper to hash than its name
+        """
+        return datablock.session_uid
+
+    def object_ref(self, object):
+        """
+        A handle on a Blender object that can be kept from one step of a modal export to the next.
+
+        The scene can be edited (or undone) while the export hands control back to Blender, which frees
+        or moves the object, so the object itself is looked up again by name with :meth:`resolve_object`
+        """
+        return (object.name, None if object.library is None else object.library.filepath)
+
+    def resolve_object(self, ref):
+        """Look up the object of an object_ref handle, or return None if it has been removed or renamed since"""
+        object = bpy.data.objects.get(ref)
+        if object is None:
+            self.report(
+                {"WARNING"},
+                f"Object '{ref[0]}' was removed or renamed during the export, skipping it.",
+            )
+        return object
+
+    def resolve_objects(self, refs):
+        """Look up the objects of a list of object_ref handles, skipping the ones that are gone"""
+        objects = []
+        for ref in refs:
+            object = self.resolve_object(ref)
+            if object is not None:
+                objects.append(object)
+        return objects
+
     def material_name(self, b_name):
         return f"{b_name.replace(' ', '_')}"
 
     def follow_link(self, socket):
         """
-        Recursively follow a link potentially via reroute nodes
+        Follow a link potentially via a chain of reroute nodes
         """
-        if socket.is_linked and socket.links[0].from_node.bl_idname == "NodeReroute":
-            return self.follow_link(socket.links[0].from_node.inputs[0])
-        else:
-            return socket
+        while socket.is_linked:
+            from_node = socket.links[0].from_node
+            if from_node.bl_idname != "NodeReroute":
+                break
+            socket = from_node.inputs[0]
+        return socket
 
     def color(self, value):
         """
@@ -153,6 +311,11 @@ class SceneWriter:
             return value
         else:
             value = list(value)
+
+            # fast path for the usual RGB(A) float colors coming from Blender sockets
+            if len(value) in (3, 4) and all(type(x) is float for x in value):
+                return value[:3]
+
             if any(not isinstance(x, (float, int, tuple)) for x in value):
                 raise ValueError(f"Unknown color entry: {value}")
             if any(type(value[i]) != type(value[i + 1]) for i in range(len(value) - 1)):
@@ -174,26 +337,25 @@ class SceneWriter:
             mat = matrix
         else:  # 3x3
             mat = matrix.to_4x4()
-        return {"matrix": list(i for j in mat for i in j)}
+        return {"matrix": np.array(mat, dtype=np.float64).ravel().tolist()}
 
     def LRS_matrix(self, loc, rot, sca):
-        self.info(
-            f"Writing matrix as\n\t{loc}\n\t{tuple(degrees(a) for a in rot)}\n\t{sca}"
-        )
+        rot_x, rot_y, rot_z = degrees(rot.x), degrees(rot.y), degrees(rot.z)
+        if self.verbose:
+            self.info(f"Writing matrix as\n\t{loc}\n\t{rot_x, rot_y, rot_z}\n\t{sca}")
 
+        # compare components directly rather than slicing the vectors into tuples
         params = []
-        if sca[:] != (1, 1, 1):
-            params.append({"scale": sca[:]})
-        if rot[:] != (0, 0, 0):
-            params.extend(
-                [
-                    {"rotate": (degrees(rot.x), 1, 0, 0)},
-                    {"rotate": (degrees(rot.y), 0, 1, 0)},
-                    {"rotate": (degrees(rot.z), 0, 0, 1)},
-                ]
-            )
-        if loc[:] != (0, 0, 0):
-            params.append({"translate": loc[:]})
+        if not (sca.x == 1 and sca.y == 1 and sca.z == 1):
+            params.append({"scale": (sca.x, sca.y, sca.z)})
+        if rot.x or rot.y or rot.z:
+            params += [
+                {"rotate": (rot_x, 1, 0, 0)},
+                {"rotate": (rot_y, 0, 1, 0)},
+                {"rotate": (rot_z, 0, 0, 1)},
+            ]
+        if loc.x or loc.y or loc.z:
+            params.append({"translate": (loc.x, loc.y, loc.z)})
 
         return params
 
@@ -202,55 +364,61 @@ class SceneWriter:
         get node connected to a specific world input socket.
         """
 
-        output_node_id = "World Output"
-
-        world = self.context.scene.world
+        # the world output node is looked up once and shared by all sockets
+        if self.world_output is False:
+            world = self.context.scene.world
+            if world is None or not world.use_nodes or world.node_tree is None:
+                self.world_output = None
+            else:
+                self.world_output = world.node_tree.nodes.get("World Output")
 
-        if (
-            world is None
-            or not world.use_nodes
-            or world.node_tree is None
-            or output_node_id not in world.node_tree.nodes
-        ):
+        if self.world_output is None:
             return None
 
-        output_node = world.node_tree.nodes[output_node_id]
-
-        if (
-            socket_name not in output_node.inputs
-            or not output_node.inputs[socket_name].is_linked
-        ):
+        socket = self.world_output.inputs.get(socket_name)
+        if socket is None or not socket.is_linked:
             return None
 
-        return self.follow_link(output_node.inputs[socket_name]).links[0].from_node
+        return self.follow_link(socket).links[0].from_node
 
     def make_misc(self):
         """Adds default values to make the scene complete"""
 
-        params = {}
-
-        params["sampler"] = {"samples": self.context.scene.cycles.samples}
-
+        sampler = {"samples": self.context.scene.cycles.samples}
         if self.sampler != "none":
-            params["sampler"].update({"type": self.sampler})
+            sampler["type"] = self.sampler
+
+        params = {
+            "sampler": sampler,
+            "background": (
+                textures.convert_background(self) if self.enable_background else 5
+            ),
+            "accelerator": {"type": "bbh"},
+        }
 
         if self.integrator != "none":
             params["integrator"] = {"type": self.integrator}
 
-        if self.enable_background:
-            params["background"] = textures.convert_background(self)
-        else:
-            params["background"] = 5
-
-        params["accelerator"] = {"type": "bbh"}
-
         return params
 
     def dump(self, obj, name="obj"):
+        """Debugging aid: report every attribute of a Blender object in verbose mode"""
+        if not self.verbose:
+            return
         for attr in dir(obj):
-            self.report({"INFO"}, f"{name}.{attr} = {getattr(obj, attr)}")
+            try:
+                value = getattr(obj, attr)
+            except Exception:
+                continue
+            self.info(f"{name}.{attr} = {value}")
+
+    def convert_nanovdb(self, volume, copies=None):
+        """
+        Convert a volume object's material and medium.
 
-    def convert_nanovdb(self, volume):
+        copies : if given, append the (source, destination) of the grid file copy to this list
+                 instead of copying it right away
+        """
 
         volumes_folder = os.path.join(self.directory, "volumes")
 
@@ -281,12 +449,10 @@ class SceneWriter:
             if not mat.use_nodes:
                 raise NotImplementedError("Material does not use nodes")
 
-            output_node_id = "Material Output"
-            if output_node_id not in mat.node_tree.nodes:
+            output_node = mat.node_tree.nodes.get("Material Output")
+            if output_node is None:
                 raise NotImplementedError("Cannot find material output node")
 
-            output_node = mat.node_tree.nodes[output_node_id]
-
             if (
                 "Surface" in output_node.inputs
                 and output_node.inputs["Surface"].is_linked
@@ -335,7 +501,10 @@ class SceneWriter:
 
                 # copy vdb_file into the volumes directory
                 if self.write_texture_files:
-                    shutil.copy(vdb_path, volumes_folder)
+                    if copies is None:
+                        copy_file(vdb_path, volumes_folder)
+                    else:
+                        copies.append((vdb_path, volumes_folder))
 
                 return mat_params
 
@@ -348,16 +517,18 @@ class SceneWriter:
 
     def export_volumes(self, volumes):
         volumes_json = []
+        view_layer = bpy.context.view_layer
+        copies = []
 
         for volume in volumes:
 
-            # save and turn off constraints
-            influences = []
-            for i, c in enumerate(volume.constraints):
-                influences.append(c.influence)
-                c.influence = 0.0
-
-            bpy.context.view_layer.update()
+            # save and turn off constraints, only re-evaluating the scene if there are any
+            constraints = volume.constraints
+            influences = [c.influence for c in constraints]
+            if influences:
+                for c in constraints:
+                    c.influence = 0.0
+                view_layer.update()
 
             # create a surface for the bounding box of the volume and assign the appropriate material and interior medium
             params = {
@@ -367,34 +538,82 @@ class SceneWriter:
             }
 
             # get bounding box
-            # volume.bound_box is a multi-dimensoional 8*3 array of floats, print it out as 8 rows of 3 values each
-            self.report({"INFO"}, f"bbox1:")
-            for i, bb in enumerate(volume.bound_box):
-                self.report({"INFO"}, f"volume.bound_box[{i}] = {bb[0], bb[1], bb[2]}")
-
-            min_corner = [min(bb[i] for bb in volume.bound_box) for i in range(3)]
-            max_corner = [max(bb[i] for bb in volume.bound_box) for i in range(3)]
-            for i, bb in enumerate(volume.bound_box):
-                self.report({"INFO"}, f"volume.bound_box[{i}] = {bb[0], bb[1], bb[2]}")
-            self.report({"INFO"}, f"min_corner = {min_corner}")
-            self.report({"INFO"}, f"max_corner = {max_corner}")
+            # volume.bound_box is a multi-dimensional 8*3 array of floats, logged as 8 rows of 3 values when verbose
+            bound_box = np.array(volume.bound_box, dtype=np.float64)
+            min_corner = bound_box.min(axis=0).tolist()
+            max_corner = bound_box.max(axis=0).tolist()
+            if self.verbose:
+                for i, bb in enumerate(bound_box.tolist()):
+                    self.info(f"volume.bound_box[{i}] = {tuple(bb)}")
+                self.info(f"min_corner = {min_corner}")
+                self.info(f"max_corner = {max_corner}")
             params["min corner"] = min_corner
             params["max corner"] = max_corner
 
-            params["material"] = self.convert_nanovdb(volume)
+            params["material"] = self.convert_nanovdb(volume, copies)
 
             # restore constraints
-            for i, c in enumerate(volume.constraints):
-                c.influence = influences[i]
-
-            bpy.context.view_layer.update()
+            if influences:
+                for c, influence in zip(constraints, influences):
+                    c.influence = influence
+                view_layer.update()
 
             volumes_json.append(params)
 
+        # several volume objects can use the same grid file, so copy each destination only once:
+        # two workers must never write the same file
+        unique_copies = {}
+        for source, directory in copies:
+            unique_copies.setdefault(os.path.join(directory, os.path.basename(source)), (source, directory))
+
+        # the Blender side has to stay on the main thread, but the grid files can be copied in
+        # parallel once all volumes have been converted
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            # consume the results so that errors in the workers are raised here
+            list(executor.map(lambda copy: copy_file(*copy), unique_copies.values()))
+
         return volumes_json
 
     def write(self):
         """Main method to write the blender scene into Darts format"""
+        for _ in self.write_steps():
+            pass
+
+    def write_steps(self):
+        """
+        Write the blender scene into Darts format one stage at a time.
+
+        This is a generator that yields the fraction of the export that is done after each step (a stage,
+        or a single object of the material and mesh stages), so that the export operator can hand control
+        back to Blender's UI in between.
+        """
+        if not self.profile:
+            yield from self.write_stages()
+            return
+
+        # only profile the export itself, not whatever Blender does in between stages
+        import cProfile
+
+        profiler = cProfile.Profile()
+        stages = self.write_stages()
+        try:
+            while True:
+                profiler.enable()
+                try:
+                    progress = next(stages)
+                except StopIteration:
+                    break
+                finally:
+                    profiler.disable()
+                yield progress
+        finally:
+            stages.close()
+            profile_path = os.path.join(self.directory, "profile_exporter.prof")
+            profiler.dump_stats(profile_path)
+            self.report({"INFO"}, f"Wrote export profile to '{profile_path}'")
+
+    def write_stages(self):
+        """The export stages driven by :meth:`write_steps`"""
 
         start = time.perf_counter()
 
@@ -406,6 +625,8 @@ class SceneWriter:
 
         data_all["media"] = []
 
+        scene = self.context.scene
+
         volume_node = self.get_world_input("Volume")
         if volume_node is not None:
             self.world_medium = materials.cycles_volume_to_dict(
@@ -413,48 +634,64 @@ class SceneWriter:
             )
             data_all["media"].extend(self.world_medium)
 
-        data_all["camera"] = camera.export(self, self.context.scene)
+        data_all["camera"] = camera.export(self, scene)
 
         # adding defaults
         data_all.update(self.make_misc())
 
-        # start with just the objects visible to the renderer
-        objects = [o for o in self.context.scene.objects if not o.hide_render]
-
-        # figure out the list based on the export settings
-        if self.use_selection:
-            objects = [o for o in objects if o.select_get()]
-        if self.use_visibility:
-            objects = [o for o in objects if o.visible_get()]
-
-        b_surfaces = [o for o in objects if o.type in SUPPORTED_TYPES]
-        b_volumes = [o for o in objects if o.type in "VOLUME"]
-
-        # export the materials
-        mats, media = materials.export(self, b_surfaces)
+        # sort the objects visible to the renderer by type in a single pass, honoring the
+        # export settings. The later stages run over several steps, so only keep object_ref handles
+        object_ref = self.object_ref
+        b_surfaces = []
+        b_volumes = []
+        b_lights = []
+        for o in scene.objects:
+            if o.hide_render:
+                continue
+            if self.use_selection and not o.select_get():
+                continue
+            if self.use_visibility and not o.visible_get():
+                continue
+
+            object_type = o.type
+            if object_type in SUPPORTED_TYPES:
+                b_surfaces.append(object_ref(o))
+            elif object_type == "VOLUME":
+                b_volumes.append(object_ref(o))
+            elif object_type == "LIGHT":
+                b_lights.append(object_ref(o))
+        yield 0.1
+
+        # export the materials, one object at a time
+        mats, media = yield from scaled_progress(materials.export(self, b_surfaces), 0.1, 0.3)
 
         data_all["media"].extend(media)
         data_all["materials"] = mats
+        yield 0.3
 
-        # export meshes
-        data_all["surfaces"] = geometry.export(self, b_surfaces)
+        # export meshes, one object at a time in SPLIT mode
+        data_all["surfaces"] = yield from scaled_progress(geometry.export(self, b_surfaces), 0.3, 0.7)
+        yield 0.7
 
         # add the volumes
-        data_all["surfaces"].extend(self.export_volumes(b_volumes))
+        data_all["surfaces"].extend(self.export_volumes(self.resolve_objects(b_volumes)))
+        yield 0.8
 
         # export lights
         if self.use_lights:
-            b_lights = [o for o in objects if o.type in {"LIGHT"}]
-            data_all["surfaces"].extend(lights.export(self, b_lights))
+            data_all["surfaces"].extend(lights.export(self, self.resolve_objects(b_lights)))
+        yield 0.9
+
+        # finish writing the textures
+        textures.copy_textures(self)
 
         # write the json file
-        with open(self.filepath, "w") as dump_file:
-            exported_json_string = json.dumps(data_all, indent=4)
-            dump_file.write(exported_json_string)
-            dump_file.close
+        with open(self.filepath, "wb", buffering=geometry.WRITE_BUFFER_SIZE) as dump_file:
+            dump_json(data_all, dump_file)
 
         end = time.perf_counter()
         self.report(
             {"INFO"},
             f"Scene exported successfully to '{self.filepath}' in {end-start} s!",
         )
+        yield 1.0
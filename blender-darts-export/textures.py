@@ -2,10 +2,162 @@ import numpy as np
 from mathutils import Matrix
 from collections.abc import Iterable
 import os
+import math
+import hashlib
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import bpy
+
+
+# File extensions of the image formats Darts can read
+TEXTURE_EXTS = {
+    "BMP": ".bmp",
+    "HDR": ".hdr",
+    "JPEG": ".jpg",
+    "JPEG2000": ".jpg",
+    "PNG": ".png",
+    "OPEN_EXR": ".exr",
+    "OPEN_EXR_MULTILAYER": ".exr",
+    "TARGA": ".tga",
+    "TARGA_RAW": ".tga",
+}
+
+# Image formats Darts can't read, and what to convert them to
+CONVERT_FORMAT = {"CINEON": "EXR", "DPX": "EXR", "TIFF": "PNG", "IRIS": "PNG"}
+
+WRAP_MODES = {"REPEAT": "repeat", "EXTEND": "CLAMP", "CLIP": "black"}
+
+WAVE_PROFILES = {"SIN": "sine", "SAW": "saw", "TRI": "triangle"}
+
+DIMENSIONS = {"1D": 1, "2D": 2, "3D": 3, "4D": 4}
+
+# Records, in the textures folder, which source and settings each exported texture was written from
+TEXTURE_MANIFEST = ".darts_textures.json"
+
+
+def by_node_class(converters):
+    """
+    Key a table of converters by node class rather than bl_idname, so nodes can be
+    dispatched on type(node). Node types missing from this Blender version are dropped
+    """
+    return {
+        getattr(bpy.types, bl_idname): converter
+        for bl_idname, converter in converters.items()
+        if hasattr(bpy.types, bl_idname)
+    }
+
+
+def inputs_by_name(node):
+    """Resolve all of a node's input sockets by name in one pass over the collection"""
+    return {socket.name: socket for socket in node.inputs}
+
+
+# Color written in place of disabled nodes. It is shared by every use, so it is a tuple
+DUMMY_COLOR = (0.0, 1.0, 0.3)
 
 
 def dummy_color(ctx):
-    return ctx.color([0.0, 1.0, 0.3])
+    return DUMMY_COLOR
+
+
+def load_texture_manifest(textures_folder):
+    """Read the manifest of a previous export to textures_folder, see :func:`is_up_to_date`"""
+    try:
+        with open(os.path.join(textures_folder, TEXTURE_MANIFEST), "rb") as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+
+def save_texture_manifest(ctx):
+    if ctx.texture_manifest is None:
+        return
+    manifest_path = os.path.join(ctx.directory, "textures", TEXTURE_MANIFEST)
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(ctx.texture_manifest, file)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def texture_record(image, source_path):
+    """
+    What a texture written from a file-backed image depends on: the source file (its path, size, and
+    modification time) and the settings it is saved with. None if the source file is missing
+    """
+    try:
+        stat = os.stat(source_path)
+    except OSError:
+        return None
+    return [
+        os.path.normcase(os.path.abspath(source_path)),
+        stat.st_size,
+        stat.st_mtime_ns,
+        image.file_format,
+        image.colorspace_settings.name,
+    ]
+
+
+def is_up_to_date(ctx, name, target_path, record):
+    """
+    Whether the texture at target_path was written by an earlier export from the source and settings
+    in record, and hasn't been replaced since
+    """
+    entry = ctx.texture_manifest.get(name)
+    if record is None or entry is None or entry.get("source") != record:
+        return False
+    try:
+        stat = os.stat(target_path)
+    except OSError:
+        return False
+    return entry.get("target") == [stat.st_size, stat.st_mtime_ns]
+
+
+def record_texture(ctx, name, target_path, record):
+    """Remember what the texture just written to target_path was made from, see :func:`is_up_to_date`"""
+    if record is None:
+        ctx.texture_manifest.pop(name, None)
+        return
+    stat = os.stat(target_path)
+    ctx.texture_manifest[name] = {"source": record, "target": [stat.st_size, stat.st_mtime_ns]}
+
+
+def copy_texture(source_path, temp_path, target_path):
+    shutil.copyfile(source_path, temp_path)
+    os.replace(temp_path, target_path)
+
+
+def copy_textures(ctx):
+    """
+    Copy the texture files queued by :func:`export_image`, and save the texture manifest
+
+    Saving images needs Blender and happens right away on the main thread, but plain file copies
+    don't, so they are done in parallel once everything else has been exported.
+    """
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        # consume the results so that errors in the workers are raised here
+        list(executor.map(lambda copy: copy_texture(*copy[:3]), ctx.texture_copies))
+    for _, _, target_path, name, record in ctx.texture_copies:
+        record_texture(ctx, name, target_path, record)
+    ctx.texture_copies.clear()
+
+    save_texture_manifest(ctx)
+
+
+def unique_texture_name(ctx, name):
+    """
+    Make a texture file name unique within this export. Different images can end up with the same name
+    (e.g. 'wood.png' next to 'wood', or library images sharing a name), and their files must not
+    overwrite each other. Names are compared case-insensitively, as on Windows and macOS file systems
+    """
+    base, ext = os.path.splitext(name)
+    unique_name = name
+    suffix = 0
+    while unique_name.lower() in ctx.texture_names:
+        suffix += 1
+        unique_name = f"{base}.{suffix:03d}{ext}"
+    ctx.texture_names.add(unique_name.lower())
+    return unique_name
 
 
 def export_image(ctx, image):
@@ -16,43 +168,80 @@ def export_image(ctx, image):
     image : The Blender Image object
     """
 
-    texture_exts = {
-        "BMP": ".bmp",
-        "HDR": ".hdr",
-        "JPEG": ".jpg",
-        "JPEG2000": ".jpg",
-        "PNG": ".png",
-        "OPEN_EXR": ".exr",
-        "OPEN_EXR_MULTILAYER": ".exr",
-        "TARGA": ".tga",
-        "TARGA_RAW": ".tga",
-    }
-
-    convert_format = {"CINEON": "EXR", "DPX": "EXR", "TIFF": "PNG", "IRIS": "PNG"}
+    # each image only needs to be written once, however many nodes use it
+    image_id = image.as_pointer()
+    if image_id in ctx.exported_images:
+        return ctx.exported_images[image_id]
 
     textures_folder = os.path.join(ctx.directory, "textures")
-    if image.file_format in convert_format:
+    converted = image.file_format in CONVERT_FORMAT
+    if converted:
         ctx.info(
-            f"Image format of '{image.name}' is not supported. Converting it to {convert_format[image.file_format]}."
+            f"Image format of '{image.name}' is not supported. Converting it to {CONVERT_FORMAT[image.file_format]}."
         )
-        image.file_format = convert_format[image.file_format]
+        image.file_format = CONVERT_FORMAT[image.file_format]
+
+    # different image datablocks can hold the same pixels, e.g. when a file was loaded twice or
+    # appended from another .blend. Unmodified images are identified by where their data comes from
+    source_path = bpy.path.abspath(image.filepath, library=image.library)
+    on_disk = False
+    content_key = None
+    if not converted and not image.is_dirty:
+        if image.packed_file is not None:
+            digest = hashlib.blake2b(image.packed_file.data).digest()
+            content_key = ("packed", digest, image.file_format)
+        elif image.source == "FILE" and os.path.isfile(source_path):
+            on_disk = True
+            content_key = ("file", os.path.normcase(os.path.abspath(source_path)))
+    if content_key in ctx.exported_images:
+        ctx.info(f"Image '{image.name}' is a duplicate of an exported image.")
+        ctx.exported_images[image_id] = ctx.exported_images[content_key]
+        return ctx.exported_images[image_id]
+
     original_name = os.path.basename(image.filepath)
     # Try to remove extensions from names of packed files to avoid stuff like 'Image.png.001.png'
     if original_name != "" and image.name.startswith(original_name):
         base_name, _ = os.path.splitext(original_name)
         name = image.name.replace(original_name, base_name, 1)  # Remove the extension
-        name += texture_exts[image.file_format]
+        name += TEXTURE_EXTS[image.file_format]
     else:
-        name = f"{image.name}{texture_exts[image.file_format]}"
+        name = f"{image.name}{TEXTURE_EXTS[image.file_format]}"
+    name = unique_texture_name(ctx, name)
     if ctx.write_texture_files:
         target_path = os.path.join(textures_folder, name)
-        if not os.path.isdir(textures_folder):
-            os.makedirs(textures_folder)
-        old_filepath = image.filepath
-        image.filepath_raw = target_path
-        image.save()
-        image.filepath_raw = old_filepath
-    return f"textures/{name}"
+        if not ctx.textures_folder_created:
+            os.makedirs(textures_folder, exist_ok=True)
+            ctx.textures_folder_created = True
+            ctx.texture_manifest = load_texture_manifest(textures_folder)
+        # write to a temporary file first, so an interrupted export never leaves a truncated texture
+        temp_path = target_path + ".tmp"
+        # only textures written from an unedited file can be up to date: packed and edited images have
+        # no source whose changes we could notice
+        from_file = image.source == "FILE" and image.packed_file is None and not image.is_dirty
+        record = texture_record(image, source_path) if from_file else None
+        if on_disk and content_key[1] == os.path.normcase(os.path.abspath(target_path)):
+            pass  # the source already is the exported texture
+        elif is_up_to_date(ctx, name, target_path, record):
+            # exported before from the same source and settings (e.g. re-exporting a scene)
+            ctx.info(f"Image '{image.name}' is up to date.")
+        elif on_disk:
+            # the file on disk is already what we want: copy it instead of
+            # decoding and (slowly, for PNGs) re-encoding it
+            ctx.texture_copies.append((source_path, temp_path, target_path, name, record))
+        else:
+            old_filepath = image.filepath
+            image.filepath_raw = temp_path
+            try:
+                image.save()
+            finally:
+                image.filepath_raw = old_filepath
+            os.replace(temp_path, target_path)
+            record_texture(ctx, name, target_path, record)
+
+    if content_key is not None:
+        ctx.exported_images[content_key] = f"textures/{name}"
+    ctx.exported_images[image_id] = f"textures/{name}"
+    return ctx.exported_images[image_id]
 
 
 def convert_image_texture_node(ctx, out_socket):
@@ -61,6 +250,23 @@ def convert_image_texture_node(ctx, out_socket):
     User docs: https://docs.blender.org/manual/en/latest/render/shader_nodes/textures/image.html
     """
     node = out_socket.node
+
+    # nodes that use the same image in the same way (e.g. a base color and alpha sharing one
+    # file) produce identical textures. Textures with a linked vector input are left alone
+    key = None
+    if not node.inputs["Vector"].is_linked:
+        key = (
+            node.image.as_pointer(),
+            node.image.colorspace_settings.name,
+            node.interpolation,
+            node.projection,
+            node.projection_blend,
+            node.extension,
+            out_socket.name,
+        )
+        if key in ctx.image_textures:
+            return ctx.image_textures[key]
+
     params = {
         "type": "image",
         "filename": export_image(ctx, node.image),
@@ -92,11 +298,12 @@ def convert_image_texture_node(ctx, out_socket):
             {"WARNING"},
             f"'CLIP' extension mode behaves differently in Blender than in Darts.",
         )
-    modes = {"REPEAT": "repeat", "EXTEND": "CLAMP", "CLIP": "black"}
-    params["wrap mode x"] = params["wrap mode y"] = modes[node.extension]
+    params["wrap mode x"] = params["wrap mode y"] = WRAP_MODES[node.extension]
 
-    if node.inputs["Vector"].is_linked:
+    if key is None:
         params["vector"] = convert_texture_node(ctx, node.inputs["Vector"])
+    else:
+        ctx.image_textures[key] = params
 
     return params
 
@@ -168,26 +375,27 @@ def convert_brick_texture_node(ctx, out_socket):
         return dummy_color(ctx)
 
     node = out_socket.node
+    inputs = inputs_by_name(node)
     params = {
         "type": "brick",
         "offset": node.offset,
         "offset frequency": node.offset_frequency,
         "squash": node.squash,
         "squash frequency": node.squash_frequency,
-        "color1": convert_texture_node(ctx, node.inputs["Color1"]),
-        "color2": convert_texture_node(ctx, node.inputs["Color2"]),
-        "mortar": convert_texture_node(ctx, node.inputs["Mortar"]),
-        "scale": convert_texture_node(ctx, node.inputs["Scale"]),
-        "mortar size": convert_texture_node(ctx, node.inputs["Mortar Size"]),
-        "mortar smooth": convert_texture_node(ctx, node.inputs["Mortar Smooth"]),
-        "bias": convert_texture_node(ctx, node.inputs["Bias"]),
-        "brick width": convert_texture_node(ctx, node.inputs["Brick Width"]),
-        "row height": convert_texture_node(ctx, node.inputs["Row Height"]),
+        "color1": convert_texture_node(ctx, inputs["Color1"]),
+        "color2": convert_texture_node(ctx, inputs["Color2"]),
+        "mortar": convert_texture_node(ctx, inputs["Mortar"]),
+        "scale": convert_texture_node(ctx, inputs["Scale"]),
+        "mortar size": convert_texture_node(ctx, inputs["Mortar Size"]),
+        "mortar smooth": convert_texture_node(ctx, inputs["Mortar Smooth"]),
+        "bias": convert_texture_node(ctx, inputs["Bias"]),
+        "brick width": convert_texture_node(ctx, inputs["Brick Width"]),
+        "row height": convert_texture_node(ctx, inputs["Row Height"]),
         "output": "float" if out_socket.name == "Fac" else "color",
     }
 
-    if node.inputs["Vector"].is_linked:
-        params["vector"] = convert_texture_node(ctx, node.inputs["Vector"])
+    if inputs["Vector"].is_linked:
+        params["vector"] = convert_texture_node(ctx, inputs["Vector"])
 
     return params
 
@@ -201,7 +409,7 @@ def convert_wave_texture_node(ctx, out_socket):
         return ctx.color(0.5)
 
     node = out_socket.node
-    profiles = {"SIN": "sine", "SAW": "saw", "TRI": "triangle"}
+    inputs = inputs_by_name(node)
     params = {
         "type": "wave",
         "wave type": node.wave_type.lower(),
@@ -210,17 +418,17 @@ def convert_wave_texture_node(ctx, out_socket):
             if node.wave_type == "BANDS"
             else node.rings_direction.lower()
         ),
-        "profile": profiles[node.wave_profile],
-        "scale": convert_texture_node(ctx, node.inputs["Scale"]),
-        "distortion": convert_texture_node(ctx, node.inputs["Distortion"]),
-        "detail": convert_texture_node(ctx, node.inputs["Detail"]),
-        "detail scale": convert_texture_node(ctx, node.inputs["Detail Scale"]),
-        "detail roughness": convert_texture_node(ctx, node.inputs["Detail Roughness"]),
-        "phase offset": convert_texture_node(ctx, node.inputs["Phase Offset"]),
+        "profile": WAVE_PROFILES[node.wave_profile],
+        "scale": convert_texture_node(ctx, inputs["Scale"]),
+        "distortion": convert_texture_node(ctx, inputs["Distortion"]),
+        "detail": convert_texture_node(ctx, inputs["Detail"]),
+        "detail scale": convert_texture_node(ctx, inputs["Detail Scale"]),
+        "detail roughness": convert_texture_node(ctx, inputs["Detail Roughness"]),
+        "phase offset": convert_texture_node(ctx, inputs["Phase Offset"]),
     }
 
-    if node.inputs["Vector"].is_linked:
-        params["vector"] = convert_texture_node(ctx, node.inputs["Vector"])
+    if inputs["Vector"].is_linked:
+        params["vector"] = convert_texture_node(ctx, inputs["Vector"])
 
     return params
 
@@ -232,8 +440,7 @@ def convert_white_noise_texture_node(ctx, out_socket):
     """
 
     node = out_socket.node
-    dimensions = {"1D": 1, "2D": 2, "3D": 3, "4D": 4}
-    dims = dimensions[node.noise_dimensions]
+    dims = DIMENSIONS[node.noise_dimensions]
     params = {
         "type": "white noise",
         "dimensions": dims,
@@ -258,24 +465,24 @@ def convert_noise_texture_node(ctx, out_socket):
         return ctx.color(0.5)
 
     node = out_socket.node
-    dimensions = {"1D": 1, "2D": 2, "3D": 3, "4D": 4}
-    dims = dimensions[node.noise_dimensions]
+    inputs = inputs_by_name(node)
+    dims = DIMENSIONS[node.noise_dimensions]
     params = {
         "type": "noise",
-        "scale": convert_texture_node(ctx, node.inputs["Scale"]),
-        "detail": convert_texture_node(ctx, node.inputs["Detail"]),
-        "roughness": convert_texture_node(ctx, node.inputs["Roughness"]),
-        "distortion": convert_texture_node(ctx, node.inputs["Distortion"]),
+        "scale": convert_texture_node(ctx, inputs["Scale"]),
+        "detail": convert_texture_node(ctx, inputs["Detail"]),
+        "roughness": convert_texture_node(ctx, inputs["Roughness"]),
+        "distortion": convert_texture_node(ctx, inputs["Distortion"]),
         "dimensions": dims,
         "normalize": node.normalize,
         "output": "float" if out_socket.name == "Fac" else "color",
     }
 
     if dims == 1 or dims == 4:
-        params["w"] = convert_texture_node(ctx, node.inputs["W"])
+        params["w"] = convert_texture_node(ctx, inputs["W"])
 
-    if dims != 1 and node.inputs["Vector"].is_linked:
-        params["vector"] = convert_texture_node(ctx, node.inputs["Vector"])
+    if dims != 1 and inputs["Vector"].is_linked:
+        params["vector"] = convert_texture_node(ctx, inputs["Vector"])
 
     return params
 
@@ -289,12 +496,12 @@ def convert_voronoi_texture_node(ctx, out_socket):
         return ctx.color(0.5)
 
     node = out_socket.node
-    dimensions = {"1D": 1, "2D": 2, "3D": 3, "4D": 4}
-    dims = dimensions[node.voronoi_dimensions]
+    inputs = inputs_by_name(node)
+    dims = DIMENSIONS[node.voronoi_dimensions]
     params = {
         "type": "voronoi",
-        "scale": convert_texture_node(ctx, node.inputs["Scale"]),
-        "randomness": convert_texture_node(ctx, node.inputs["Randomness"]),
+        "scale": convert_texture_node(ctx, inputs["Scale"]),
+        "randomness": convert_texture_node(ctx, inputs["Randomness"]),
         "dimensions": dims,
         "feature": node.feature.lower().replace("_", " "),
         "distance": node.distance.lower(),
@@ -302,13 +509,13 @@ def convert_voronoi_texture_node(ctx, out_socket):
     }
 
     if params["feature"] == "smooth f1":
-        params["smoothness"] = convert_texture_node(ctx, node.inputs["Smoothness"])
+        params["smoothness"] = convert_texture_node(ctx, inputs["Smoothness"])
 
     if dims == 1 or dims == 4:
-        params["w"] = convert_texture_node(ctx, node.inputs["W"])
+        params["w"] = convert_texture_node(ctx, inputs["W"])
 
-    if dims != 1 and node.inputs["Vector"].is_linked:
-        params["vector"] = convert_texture_node(ctx, node.inputs["Vector"])
+    if dims != 1 and inputs["Vector"].is_linked:
+        params["vector"] = convert_texture_node(ctx, inputs["Vector"])
 
     return params
 
@@ -322,25 +529,25 @@ def convert_musgrave_texture_node(ctx, out_socket):
         return ctx.color(0.5)
 
     node = out_socket.node
-    dimensions = {"1D": 1, "2D": 2, "3D": 3, "4D": 4}
-    dims = dimensions[node.noise_dimensions]
+    inputs = inputs_by_name(node)
+    dims = DIMENSIONS[node.noise_dimensions]
     params = {
         "type": "musgrave",
         "fractal type": node.musgrave_type.lower().replace("_", " "),
-        "scale": convert_texture_node(ctx, node.inputs["Scale"]),
-        "detail": convert_texture_node(ctx, node.inputs["Detail"]),
-        "dimension": convert_texture_node(ctx, node.inputs["Dimension"]),
-        "lacunarity": convert_texture_node(ctx, node.inputs["Lacunarity"]),
-        "offset": convert_texture_node(ctx, node.inputs["Offset"]),
-        "gain": convert_texture_node(ctx, node.inputs["Gain"]),
+        "scale": convert_texture_node(ctx, inputs["Scale"]),
+        "detail": convert_texture_node(ctx, inputs["Detail"]),
+        "dimension": convert_texture_node(ctx, inputs["Dimension"]),
+        "lacunarity": convert_texture_node(ctx, inputs["Lacunarity"]),
+        "offset": convert_texture_node(ctx, inputs["Offset"]),
+        "gain": convert_texture_node(ctx, inputs["Gain"]),
         "dimensions": dims,
     }
 
     if dims == 1 or dims == 4:
-        params["w"] = convert_texture_node(ctx, node.inputs["W"])
+        params["w"] = convert_texture_node(ctx, inputs["W"])
 
-    if dims != 1 and node.inputs["Vector"].is_linked:
-        params["vector"] = convert_texture_node(ctx, node.inputs["Vector"])
+    if dims != 1 and inputs["Vector"].is_linked:
+        params["vector"] = convert_texture_node(ctx, inputs["Vector"])
 
     return params
 
@@ -375,6 +582,41 @@ def convert_layer_weight_node(ctx, out_socket):
         )
 
 
+# Blend types whose result is exactly the first color for a factor of 0, including for HDR and
+# negative inputs. Left out are blend types that clamp (e.g. BURN, EXCLUSION), divide (DODGE, DIVIDE),
+# or round-trip the first color through HSV (HUE, SATURATION, VALUE, COLOR)
+BLEND_TYPES_KEEPING_COLOR1 = {
+    "MIX",
+    "ADD",
+    "SUBTRACT",
+    "MULTIPLY",
+    "SCREEN",
+    "OVERLAY",
+    "DIFFERENCE",
+    "DARKEN",
+    "LIGHTEN",
+    "SOFT_LIGHT",
+    "LINEAR_LIGHT",
+}
+
+
+def prune_mix(ctx, node, clamp_result):
+    """
+    Convert only the surviving input of a mix whose factor is a constant 0 or 1, or return None
+
+    A factor of 0 returns the first color for the blend types in BLEND_TYPES_KEEPING_COLOR1, a factor of 1
+    only returns the second color for a plain mix. Clamped results are left to Darts.
+    """
+    fac = node.inputs["Fac"]
+    if fac.is_linked or clamp_result:
+        return None
+    if fac.default_value <= 0.0 and node.blend_type in BLEND_TYPES_KEEPING_COLOR1:
+        return convert_texture_node(ctx, node.inputs["Color1"])
+    if fac.default_value >= 1.0 and node.blend_type == "MIX":
+        return convert_texture_node(ctx, node.inputs["Color2"])
+    return None
+
+
 def convert_mix_rgb_node(ctx, out_socket):
     """
     Python API: https://docs.blender.org/api/latest/bpy.types.ShaderNodeMixRGB.html
@@ -384,6 +626,10 @@ def convert_mix_rgb_node(ctx, out_socket):
         return dummy_color(ctx)
 
     node = out_socket.node
+    pruned = prune_mix(ctx, node, node.use_clamp)
+    if pruned is not None:
+        return pruned
+
     return {
         "type": "mix",
         "blend type": node.blend_type.lower().replace("_", " "),
@@ -408,6 +654,11 @@ def convert_mix_node(ctx, out_socket):
         raise NotImplementedError(
             "Only Color and Float mix nodes are currently supported in Darts"
         )
+
+    pruned = prune_mix(ctx, node, node.clamp_result)
+    if pruned is not None:
+        return pruned
+
     return {
         "type": "mix",
         "blend type": node.blend_type.lower().replace("_", " "),
@@ -526,20 +777,20 @@ def convert_mapping_node(ctx, out_socket):
     params = {"type": "mapping", "vector type": node.vector_type.lower()}
     ctx.info(f"Writing '{params['vector type']}' mapping node.")
 
-    if (
-        node.inputs["Location"].is_linked
-        or node.inputs["Rotation"].is_linked
-        or node.inputs["Scale"].is_linked
-    ):
+    location = node.inputs["Location"]
+    rotation = node.inputs["Rotation"]
+    scale = node.inputs["Scale"]
+    if location.is_linked or rotation.is_linked or scale.is_linked:
         raise NotImplementedError(
             "Location, Rotation, and Scale inputs shouldn't be linked"
         )
 
-    params["transform"] = ctx.LRS_matrix(
-        node.inputs["Location"].default_value,
-        node.inputs["Rotation"].default_value,
-        node.inputs["Scale"].default_value,
-    )
+    loc, rot, sca = location.default_value, rotation.default_value, scale.default_value
+    if tuple(loc) == (0, 0, 0) and tuple(rot) == (0, 0, 0) and tuple(sca) == (1, 1, 1):
+        # a neutral mapping, e.g. only there to switch the vector type
+        params["transform"] = []
+    else:
+        params["transform"] = ctx.LRS_matrix(loc, rot, sca)
 
     if node.inputs["Vector"].is_linked:
         params["vector"] = convert_texture_node(ctx, node.inputs["Vector"])
@@ -593,19 +844,24 @@ def convert_val_to_rgb_node(ctx, out_socket):
         return dummy_color(ctx)
 
     node = out_socket.node
+    color_ramp = node.color_ramp
+
+    # fetch all stops in bulk rather than element by element
+    elements = color_ramp.elements
+    positions = np.empty(len(elements), dtype=np.float32)
+    colors = np.empty((len(elements), 4), dtype=np.float32)
+    elements.foreach_get("position", positions)
+    elements.foreach_get("color", colors.ravel())
+
     return {
         "type": "color ramp",
         "factor": convert_texture_node(ctx, node.inputs["Fac"]),
-        "color mode": node.color_ramp.color_mode.lower(),
-        "interpolation": node.color_ramp.interpolation.lower().replace("_", "-"),
-        "hue interpolation": node.color_ramp.hue_interpolation.lower(),
+        "color mode": color_ramp.color_mode.lower(),
+        "interpolation": color_ramp.interpolation.lower().replace("_", "-"),
+        "hue interpolation": color_ramp.hue_interpolation.lower(),
         "elements": [
-            {
-                "position": e.position,
-                "color": ctx.color(e.color),
-                "alpha": e.alpha,
-            }
-            for e in node.color_ramp.elements
+            {"position": position, "color": rgba[:3], "alpha": rgba[3]}
+            for position, rgba in zip(positions.tolist(), colors.tolist())
         ],
         "output": "float" if out_socket.name == "Alpha" else "color",
     }
@@ -648,6 +904,36 @@ def convert_gradient_node(ctx, out_socket):
     }
 
 
+def prune_math(ctx, node):
+    """
+    Simplify a binary math node with one constant operand that decides the result, or return None
+
+    Handles x * 0 = 0, x * 1 = x, x + 0 = x, x - 0 = x and x ^ 0 = 1.
+    """
+    operation = node.operation
+    if operation not in ("MULTIPLY", "ADD", "SUBTRACT", "POWER"):
+        return None
+
+    a, b = node.inputs[0], node.inputs[1]
+    if a.is_linked == b.is_linked:
+        # nothing constant to simplify with, or a constant that folding already takes care of
+        return None
+
+    if operation == "POWER":
+        return 1.0 if not b.is_linked and b.default_value == 0.0 else None
+
+    linked, constant = (b, a) if b.is_linked else (a, b)
+    value = constant.default_value
+    if operation == "MULTIPLY":
+        if value == 0.0:
+            return 0.0
+        if value == 1.0:
+            return convert_texture_node(ctx, linked)
+    elif value == 0.0 and (operation == "ADD" or constant is b):  # x - 0, but not 0 - x
+        return convert_texture_node(ctx, linked)
+    return None
+
+
 def convert_math_node(ctx, out_socket):
     """
     Python API: https://docs.blender.org/api/latest/bpy.types.ShaderNodeMath.html
@@ -657,6 +943,11 @@ def convert_math_node(ctx, out_socket):
         return dummy_color(ctx)
 
     node = out_socket.node
+    if not node.use_clamp:
+        pruned = prune_math(ctx, node)
+        if pruned is not None:
+            return pruned
+
     params = {
         "type": "math",
         "operation": node.operation.lower().replace("_", " "),
@@ -673,8 +964,132 @@ def convert_math_node(ctx, out_socket):
     return params
 
 
-def convert_texture_node(ctx, socket):
-    texture_converters = {
+def _safe_divide(a, b):
+    return a / b if b != 0.0 else 0.0
+
+
+def _safe_power(a, b):
+    if a < 0.0 and b != math.floor(b):
+        return 0.0
+    try:
+        return math.pow(a, b)
+    except (OverflowError, ValueError):
+        return 0.0
+
+
+# Math node operations we can evaluate at export time (mirroring Cycles' safe variants)
+MATH_OPERATIONS = {
+    "ADD": lambda a, b, c: a + b,
+    "SUBTRACT": lambda a, b, c: a - b,
+    "MULTIPLY": lambda a, b, c: a * b,
+    "DIVIDE": lambda a, b, c: _safe_divide(a, b),
+    "MULTIPLY_ADD": lambda a, b, c: a * b + c,
+    "POWER": lambda a, b, c: _safe_power(a, b),
+    "SQRT": lambda a, b, c: math.sqrt(a) if a > 0.0 else 0.0,
+    "ABSOLUTE": lambda a, b, c: abs(a),
+    "MINIMUM": lambda a, b, c: min(a, b),
+    "MAXIMUM": lambda a, b, c: max(a, b),
+    "LESS_THAN": lambda a, b, c: float(a < b),
+    "GREATER_THAN": lambda a, b, c: float(a > b),
+    "SIGN": lambda a, b, c: float((a > 0.0) - (a < 0.0)),
+    "ROUND": lambda a, b, c: math.floor(a + 0.5),
+    "FLOOR": lambda a, b, c: math.floor(a),
+    "CEIL": lambda a, b, c: math.ceil(a),
+    "FRACT": lambda a, b, c: a - math.floor(a),
+    "MODULO": lambda a, b, c: math.fmod(a, b) if b != 0.0 else 0.0,
+    "SINE": lambda a, b, c: math.sin(a),
+    "COSINE": lambda a, b, c: math.cos(a),
+    "TANGENT": lambda a, b, c: math.tan(a),
+    "RADIANS": lambda a, b, c: math.radians(a),
+    "DEGREES": lambda a, b, c: math.degrees(a),
+}
+
+
+def _clamp01(x):
+    return min(max(x, 0.0), 1.0)
+
+
+def _eval_value_node(ctx, node, out_socket):
+    return out_socket.default_value
+
+
+def _eval_math_node(ctx, node, out_socket):
+    if not ctx.enable_math or node.operation not in MATH_OPERATIONS:
+        return None
+    args = [constant_value(ctx, i) for i in node.inputs[:3]]
+    if any(a is None for a in args):
+        return None
+    args += [0.0] * (3 - len(args))
+    result = MATH_OPERATIONS[node.operation](*args)
+    return _clamp01(result) if node.use_clamp else result
+
+
+def _eval_mix_rgb_node(ctx, node, out_socket):
+    if not ctx.enable_mix_rgb or node.blend_type != "MIX":
+        return None
+    fac = constant_value(ctx, node.inputs["Fac"])
+    a = constant_value(ctx, node.inputs["Color1"])
+    b = constant_value(ctx, node.inputs["Color2"])
+    if fac is None or a is None or b is None:
+        return None
+    # floats linked into color sockets are gray colors
+    a, b = (tuple(c) if isinstance(c, tuple) else (c, c, c, 1.0) for c in (a, b))
+    fac = _clamp01(fac)
+    result = tuple((1.0 - fac) * x + fac * y for x, y in zip(a, b))
+    return tuple(_clamp01(x) for x in result) if node.use_clamp else result
+
+
+def _eval_color_ramp_node(ctx, node, out_socket):
+    if not ctx.enable_color_ramp:
+        return None
+    fac = constant_value(ctx, node.inputs["Fac"])
+    if fac is None:
+        return None
+    rgba = tuple(node.color_ramp.evaluate(fac))
+    return rgba[3] if out_socket.name == "Alpha" else rgba
+
+
+# Nodes that can be folded into a constant when all of their inputs are constant
+constant_evaluators = {
+    "ShaderNodeValue": _eval_value_node,
+    "ShaderNodeMath": _eval_math_node,
+    "ShaderNodeMixRGB": _eval_mix_rgb_node,
+    "ShaderNodeValToRGB": _eval_color_ramp_node,
+}
+
+
+def constant_value(ctx, socket):
+    """
+    Return the value of an input socket if it doesn't depend on the shading point, or None otherwise.
+
+    Unlinked sockets return their default value; sockets linked to a subtree of constant nodes
+    (e.g. a Math node with constant inputs, or a Color Ramp with a fixed factor) are evaluated here,
+    so that the exporter can write a constant instead of the whole subtree.
+    Results are cached per output socket across all materials.
+    """
+    if not socket.is_linked:
+        value = socket.default_value
+        return value if isinstance(value, (float, int)) else tuple(value)
+
+    link = ctx.follow_link(socket).links[0]
+    node, from_socket = link.from_node, link.from_socket
+
+    # Blender converts floats to gray colors implicitly, other conversions we leave to Darts
+    if from_socket.type != socket.type and not (from_socket.type == "VALUE" and socket.type == "RGBA"):
+        return None
+
+    evaluator = constant_evaluators.get(node.bl_idname)
+    if evaluator is None:
+        return None
+
+    key = (node.as_pointer(), from_socket.identifier)
+    if key not in ctx.constant_values:
+        ctx.constant_values[key] = evaluator(ctx, node, from_socket)
+    return ctx.constant_values[key]
+
+
+texture_converters = by_node_class(
+    {
         "ShaderNodeBlackbody": convert_blackbody_node,
         "ShaderNodeTexBrick": convert_brick_texture_node,
         "ShaderNodeClamp": convert_clamp_node,
@@ -703,24 +1118,54 @@ def convert_texture_node(ctx, socket):
         "ShaderNodeTexGradient": convert_gradient_node,
         "ShaderNodeMath": convert_math_node,
     }
+)
+
+
+def convert_texture_node(ctx, socket):
+    """
+    Convert the texture feeding an input socket, or its default value if it is not linked.
 
+    Conversions of linked sockets are cached per upstream output socket for the whole export,
+    so a node that feeds many inputs is only converted once. The cached params are shared by
+    every input referring to them (the scene file gets a copy at each use), so callers must
+    not modify the params they get back.
+    """
     params = None
     if socket.is_linked:
         s = ctx.follow_link(socket)
         node = s.links[0].from_node
         from_socket = s.links[0].from_socket
 
-        if node.bl_idname in texture_converters:
+        # an output feeding several inputs (e.g. one image driving color and roughness)
+        # only needs to be converted once
+        key = (from_socket.as_pointer(), socket.type)
+        if key in ctx.converted_sockets:
+            return ctx.converted_sockets[key]
+
+        value = constant_value(ctx, socket)
+        if value is not None:
+            ctx.info(f"Folded a constant '{node.bl_idname}' Blender shader node.")
+            params = ctx.color(value)
+        else:
+            converter = texture_converters.get(type(node))
+            if converter is None:
+                raise NotImplementedError(
+                    f"Shader node type {node.bl_idname} is not supported"
+                )
             ctx.info(f"Converting a '{node.bl_idname}' Blender shader node.")
-            params = texture_converters[node.bl_idname](ctx, from_socket)
+            params = converter(ctx, from_socket)
             if params and isinstance(params, Iterable) and "type" in params:
                 ctx.info(f"  Created a '{params['type']}' texture.")
-        else:
-            raise NotImplementedError(
-                f"Shader node type {node.bl_idname} is not supported"
-            )
+        ctx.converted_sockets[key] = params
     else:
-        params = ctx.color(socket.default_value)
+        # unlinked inputs are written inline, numbers as they are and colors/vectors as triples
+        socket_type = socket.type
+        if socket_type == "VALUE":
+            params = socket.default_value
+        elif socket_type == "RGBA" or socket_type == "VECTOR":
+            params = list(socket.default_value[:3])
+        else:
+            params = ctx.color(socket.default_value)
 
     return params
 
@@ -730,41 +1175,39 @@ def convert_background(ctx):
     convert environment lighting. Constant emitter and envmaps are supported
     """
 
-    try:
-        surface_node = ctx.get_world_input("Surface")
-        if surface_node is not None:
+    def unsupported(reason):
+        ctx.report(
+            {"WARNING"},
+            f"Error while converting background: {reason}. Using default.",
+        )
+        return 5
 
-            if "Strength" not in surface_node.inputs:
-                raise NotImplementedError(
-                    "Expecting a material with a 'Strength' parameter for a background"
-                )
+    surface_node = ctx.get_world_input("Surface")
+    if surface_node is None:
+        # Single color field for emission, no nodes
+        return ctx.color(ctx.context.scene.world.color)
 
-            if surface_node.inputs["Strength"].is_linked:
-                raise NotImplementedError(
-                    "Only default emitter 'Strength' value is supported"
-                )
+    inputs = surface_node.inputs
+    strength_input = inputs.get("Strength")
+    if strength_input is None:
+        return unsupported("Expecting a material with a 'Strength' parameter for a background")
 
-            strength = surface_node.inputs["Strength"].default_value
-            if strength == 0:  # Don't add an emitter if it emits nothing
-                ctx.info("Ignoring envmap with zero strength.")
-                return 0
-
-            if surface_node.bl_idname in ["ShaderNodeBackground", "ShaderNodeEmission"]:
-                return {
-                    "type": "background",
-                    "color": convert_texture_node(ctx, surface_node.inputs["Color"]),
-                }
-            else:
-                raise NotImplementedError(
-                    f"Only Background and Emission nodes are supported as final nodes for background export, got '{surface_node.name}'"
-                )
-        else:
-            # Single color field for emission, no nodes
-            return ctx.color(ctx.context.scene.world.color)
+    if strength_input.is_linked:
+        return unsupported("Only default emitter 'Strength' value is supported")
 
-    except NotImplementedError as err:
-        ctx.report(
-            {"WARNING"},
-            f"Error while converting background: {err.args[0]}. Using default.",
+    if strength_input.default_value == 0:  # Don't add an emitter if it emits nothing
+        ctx.info("Ignoring envmap with zero strength.")
+        return 0
+
+    if surface_node.bl_idname not in ("ShaderNodeBackground", "ShaderNodeEmission"):
+        return unsupported(
+            f"Only Background and Emission nodes are supported as final nodes for background export, got '{surface_node.name}'"
         )
-        return 5
+
+    try:
+        color = convert_texture_node(ctx, inputs["Color"])
+    except NotImplementedError as err:
+        # an unsupported node in the background's color tree
+        return unsupported(err.args[0])
+
+    return {"type": "background", "color": color}
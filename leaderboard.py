@@ -1,11 +1,17 @@
 import os
-from sys import argv, exit, stderr, stdout
+from pathlib import Path
+from sys import argv, exit, stderr
 from datetime import datetime as dt
 import subprocess
+import threading
 import pickle
-import re
-import math
-import sys
+import mmap
+from collections import deque
+
+INTERSECTION_STAT = "Total intersection tests per ray"
+NODES_STAT = "Nodes visited per ray"
+# Number of trailing lines of each stream kept to report a failed render
+TAIL_LINES = 40
 
 
 def find_executable():
@@ -14,19 +20,51 @@ def find_executable():
     Try build/$<config> directory first, then build directory.
     """
 
-    root = os.getcwd()
-    darts = ""
+    root = Path.cwd()
     extension = ".exe" if os.name == "nt" else ""
 
-    if os.path.exists(os.path.join(root, "build", "Release", f"darts{extension}")):
-        darts = os.path.join(root, "build", "Release", f"darts{extension}")
-    elif os.path.exists(os.path.join(root, "build", f"darts{extension}")):
-        darts = os.path.join(root, "build", f"darts{extension}")
-    else:
-        print("Missing build dir\n")
-        return None, None
+    build = root / "build"
+    candidates = (
+        build / "Release" / f"darts{extension}",
+        build / f"darts{extension}",
+    )
+
+    for darts in candidates:
+        if darts.is_file():
+            return darts, root
+
+    print("Missing build dir\n")
+    return None, None
+
+
+def echo_lines(pipe, tail, stats=None):
+    """
+    Echo every line read from pipe, keeping the last few in tail and the
+    statistics lines we need in stats
+    """
 
-    return darts, root
+    for line in iter(pipe.readline, ""):
+        print(line, end="")
+        tail.append(line)
+        if stats is not None:
+            if INTERSECTION_STAT in line:
+                stats[INTERSECTION_STAT] = line
+            elif NODES_STAT in line:
+                stats[NODES_STAT] = line
+
+
+def parse_ratio(line):
+    """
+    Return numerator / denominator from a DARTS stats line of the form
+    "<title>   <numerator> / <denominator> (<ratio>x)"
+    """
+
+    # fmt wraps every field in color escape codes (ESC[...m), strip them first
+    first, *rest = line.split("\x1b[")
+    tokens = (first + "".join(code.partition("m")[2] for code in rest)).split()
+
+    slash = tokens.index("/")
+    return float(tokens[slash - 1]) / float(tokens[slash + 1])
 
 
 def render_image(exe_path, root_path):
@@ -46,18 +84,21 @@ def render_image(exe_path, root_path):
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         text=True,
+        bufsize=-1,
     )
 
-    stdout_lines = []
-    stderr_lines = []
+    stats = {}
+    stdout_tail = deque(maxlen=TAIL_LINES)
+    stderr_tail = deque(maxlen=TAIL_LINES)
 
-    # Read stdout and stderr in real-time
-    for stdout_line in iter(proc.stdout.readline, ""):
-        print(stdout_line, end="")
-        stdout_lines.append(stdout_line)
-    for stderr_line in iter(proc.stderr.readline, ""):
-        print(stderr_line, end="")
-        stderr_lines.append(stderr_line)
+    # Read stdout and stderr in real-time. stderr is drained on its own thread so
+    # that neither pipe can fill up and stall the renderer while we wait on the other
+    stderr_reader = threading.Thread(
+        target=echo_lines, args=(proc.stderr, stderr_tail), daemon=True
+    )
+    stderr_reader.start()
+    echo_lines(proc.stdout, stdout_tail, stats)
+    stderr_reader.join()
 
     proc.stdout.close()
     proc.stderr.close()
@@ -65,34 +106,27 @@ def render_image(exe_path, root_path):
 
     print("Finished rendering image")
 
-    out = "".join(stdout_lines)
-    err = "".join(stderr_lines)
-
-    stats_loc = out.find("Statistics:")
-    intersections = out.find("Total intersection tests per ray")
-    nodes = out.find("Nodes visited per ray")
-
-    tri_str = out[intersections:]
-    tri_str_nodes = out[nodes:]
-
-    intersection_pattern = re.compile(r".*\s+\b(\d+)\b.*\s+\b(\d+)\b")
-
-    match = intersection_pattern.match(tri_str.strip())
-    match_nodes = intersection_pattern.match(tri_str_nodes.strip())
-
-    files = [
-        os.path.join(scene_dir, fname)
-        for fname in os.listdir(scene_dir)
-        if fname.startswith(scene_name) and fname.endswith(".png")
-    ]
-
-    files.sort(key=lambda x: os.path.getmtime(x))
+    missing = [stat for stat in (INTERSECTION_STAT, NODES_STAT) if stat not in stats]
+    if missing:
+        raise RuntimeError(
+            f"DARTS output is missing the statistics: {', '.join(missing)} "
+            f"(exit code {proc.returncode})\n"
+            "stdout:\n" + "".join(stdout_tail) + "stderr:\n" + "".join(stderr_tail)
+        )
 
-    most_recent_img = files[-1]
+    with os.scandir(scene_dir) as entries:
+        most_recent_img = max(
+            (
+                entry
+                for entry in entries
+                if entry.name.startswith(scene_name) and entry.name.endswith(".png")
+            ),
+            key=lambda entry: entry.stat().st_mtime,
+        ).path
     end_time = dt.now()
 
-    intersections = float(match.group(1)) / float(match.group(2))
-    nodes = float(match_nodes.group(1)) / float(match_nodes.group(2))
+    intersections = parse_ratio(stats[INTERSECTION_STAT])
+    nodes = parse_ratio(stats[NODES_STAT])
 
     return most_recent_img, intersections, nodes, start_time, end_time
 
@@ -100,15 +134,23 @@ def render_image(exe_path, root_path):
 def create_hash(
     img_path, intersections, nodes, publicize_results, time_start, time_end
 ):
-    outfile = open("leaderboard.dat", "wb")
-    img = open(img_path, "rb")
-
-    pickle.dump(
-        [intersections, nodes, publicize_results, time_start, time_end, img.read()],
-        outfile,
-        pickle.HIGHEST_PROTOCOL,
-    )
-    outfile.close()
+    # Hand the pickler a read-only view of the mapped image instead of a bytes copy.
+    # It is still pickled in-band as bytes, so the file is byte-for-byte unchanged
+    with open(img_path, "rb") as img, mmap.mmap(
+        img.fileno(), 0, access=mmap.ACCESS_READ
+    ) as img_data, open("leaderboard.dat", "wb") as outfile:
+        pickle.dump(
+            [
+                intersections,
+                nodes,
+                publicize_results,
+                time_start,
+                time_end,
+                pickle.PickleBuffer(img_data),
+            ],
+            outfile,
+            pickle.HIGHEST_PROTOCOL,
+        )
 
 
 def main():
@@ -125,23 +167,22 @@ def main():
     print()
 
     # Note: make this True is if you want your results to be displayed on the class website leaderboard
-    publicize_results = False
-    if len(sys.argv) > 1:
-        publicize_cmd = sys.argv[1]
-        if publicize_cmd.strip() == "public":
-            publicize_results = True
-
-    img_path, intersections, nodes, time_start, time_end = render_image(
-        exe_path, scene_path
-    )
+    publicize_results = len(argv) > 1 and argv[1].strip() == "public"
+
+    try:
+        img_path, intersections, nodes, time_start, time_end = render_image(
+            exe_path, scene_path
+        )
+    except RuntimeError as e:
+        print("Error:", e, file=stderr)
+        exit(1)
 
     print("Image path:", img_path)
     print()
-    print(
-        "Total intersection tests per ray:", math.floor(intersections * 100.0) / 100.0
-    )
-    print("Nodes visited per ray:", math.floor(nodes * 100.0) / 100.0)
-    print("Figure of merit:", math.floor(nodes * intersections * 100.0) / 100.0)
+    # Metrics are truncated, not rounded, to two decimals
+    print(f"Total intersection tests per ray: {int(intersections * 100) / 100:.2f}")
+    print(f"Nodes visited per ray: {int(nodes * 100) / 100:.2f}")
+    print(f"Figure of merit: {int(nodes * intersections * 100) / 100:.2f}")
     print()
 
     create_hash(img_path, intersections, nodes, publicize_results, time_start, time_end)